@@ -1,15 +1,33 @@
 # main.py
 import subprocess
 from fastapi import FastAPI, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, Response
 from fastapi.templating import Jinja2Templates
 import ctranslate2
 import sentencepiece as spm
-import ollama
-import os, glob, re, time, logging, asyncio, httpx, uuid
+import os, sys, glob, re, time, json, logging, asyncio, httpx, uuid, unicodedata, sqlite3, threading, hashlib, platform, math
+import bisect, contextvars, random
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pydantic import BaseModel
 
+# sentence splitting + persistent segment store come from the bundled quickmt package
+# (app/quickmt/build/lib/quickmt, on PYTHONPATH in the image); the store needs only the stdlib
+quickmt_errors = {}
+try:
+    from quickmt.store import SegmentStore
+except ImportError as e:
+    SegmentStore, quickmt_errors["the segment store"] = None, e
+try:
+    from quickmt.translator import TranslatorABC  # needs blingfire
+except ImportError as e:
+    TranslatorABC, quickmt_errors["sentence splitting"] = None, e
+from static_bundle import StaticBundle, VENDOR, FONT_WEIGHTS, DIST_DIR as STATIC_DIST_DIR
+
 logger = logging.getLogger("uvicorn.error")
+for _feature, _error in quickmt_errors.items():
+    logger.warning("⚠️ quickmt import failed (%s): %s is DISABLED.", _error, _feature)
 
 app = FastAPI()
 templates = Jinja2Templates(directory="templates")
@@ -22,11 +40,137 @@ if not os.path.isdir(MODEL_DIR):
 
 OLLAMA_MODEL = "qwen2.5-coder:1.5b"
 OLLAMA_BASE = os.getenv("OLLAMA_BASE", os.getenv("OLLAMA_HOST", "http://ollama:11434"))
-OLLAMA_CHAT_PATH = "/v1/chat/completions"
+OLLAMA_CHAT_PATH = "/api/chat"
+# models offered in the UI; the keeper pins OLLAMA_KEEP_WARM (default: the same list) loaded with keep_alive
+OLLAMA_UI_MODELS = [m.strip() for m in os.getenv(
+    "OLLAMA_UI_MODELS", "qwen2.5-coder:1.5b,qwen2.5-coder:0.5b,qwen2.5-coder:3b").split(",") if m.strip()]
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_KEEP_WARM = [m.strip() for m in os.getenv("OLLAMA_KEEP_WARM", ",".join(OLLAMA_UI_MODELS)).split(",") if m.strip()]
+OLLAMA_KEEPER_INTERVAL = float(os.getenv("OLLAMA_KEEPER_INTERVAL", "240"))
+# models pulled (HTTP API) and loaded on every host at startup; calls wait up to OLLAMA_PROVISION_WAIT
+# seconds for one that is still being provisioned
+OLLAMA_PROVISION_MODELS = [OLLAMA_MODEL] + [m.strip() for m in os.getenv(
+    "OLLAMA_PROVISION_MODELS", ",".join(OLLAMA_UI_MODELS)).split(",") if m.strip()]
+OLLAMA_PROVISION_WAIT = float(os.getenv("OLLAMA_PROVISION_WAIT", "300"))
+OLLAMA_PULL_READ_TIMEOUT = float(os.getenv("OLLAMA_PULL_READ_TIMEOUT", "600"))
 BEAM = 5
 
+# shared Ollama HTTP client: connection pool + per-phase timeouts (seconds)
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "120"))
+OLLAMA_WRITE_TIMEOUT = float(os.getenv("OLLAMA_WRITE_TIMEOUT", "10"))
+OLLAMA_POOL_TIMEOUT = float(os.getenv("OLLAMA_POOL_TIMEOUT", "10"))
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "64"))
+OLLAMA_MAX_KEEPALIVE = int(os.getenv("OLLAMA_MAX_KEEPALIVE", "16"))
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "60"))
+
+# Ollama upstream pool (comma-separated base URLs, default OLLAMA_BASE): least-outstanding routing with
+# session affinity, background health checks, and a circuit breaker per host that opens after
+# OLLAMA_EJECT_AFTER failures in a row and lets one trial call through after OLLAMA_EJECT_SEC
+OLLAMA_HOSTS = [h.strip().rstrip('/') for h in os.getenv("OLLAMA_HOSTS", OLLAMA_BASE).split(",") if h.strip()]
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "10"))
+OLLAMA_EJECT_AFTER = int(os.getenv("OLLAMA_EJECT_AFTER", "3"))
+OLLAMA_EJECT_SEC = float(os.getenv("OLLAMA_EJECT_SEC", "30"))
+OLLAMA_AFFINITY_SLACK = int(os.getenv("OLLAMA_AFFINITY_SLACK", "2"))
+# connection failures (the request never reached Ollama) are retried with jittered exponential backoff
+OLLAMA_RETRIES = int(os.getenv("OLLAMA_RETRIES", "2"))
+OLLAMA_RETRY_BASE_DELAY = float(os.getenv("OLLAMA_RETRY_BASE_DELAY", "0.2"))
+OLLAMA_RETRY_MAX_DELAY = float(os.getenv("OLLAMA_RETRY_MAX_DELAY", "2"))
+# hedging: send a duplicate to a second host when the first has not answered within this percentile
+# of recent first-byte latencies (needs two hosts and OLLAMA_HEDGE_MIN_SAMPLES samples)
+OLLAMA_HEDGE = os.getenv("OLLAMA_HEDGE", "0").lower() in ("1", "true", "yes")
+OLLAMA_HEDGE_PERCENTILE = float(os.getenv("OLLAMA_HEDGE_PERCENTILE", "95"))
+OLLAMA_HEDGE_MIN_SAMPLES = int(os.getenv("OLLAMA_HEDGE_MIN_SAMPLES", "20"))
+OLLAMA_HEDGE_WINDOW = int(os.getenv("OLLAMA_HEDGE_WINDOW", "200"))
+
+# translator replicas: each replica runs inter_threads batches in parallel with intra_threads each;
+# intra_threads=0 splits the host's cores evenly across replicas * inter_threads
+TRANSLATOR_DEVICE = os.getenv("TRANSLATOR_DEVICE", "auto")
+TRANSLATOR_COMPUTE_TYPE = os.getenv("TRANSLATOR_COMPUTE_TYPE", "default")
+TRANSLATOR_REPLICAS = int(os.getenv("TRANSLATOR_REPLICAS", "1"))
+TRANSLATOR_INTER_THREADS = int(os.getenv("TRANSLATOR_INTER_THREADS", "1"))
+TRANSLATOR_INTRA_THREADS = int(os.getenv("TRANSLATOR_INTRA_THREADS", "0"))
+# after a device failure the model is reloaded once, in the background, on the fallback device;
+# another failure within the cooldown is reported instead of triggering a second reload
+TRANSLATOR_FALLBACK_DEVICE = os.getenv("TRANSLATOR_FALLBACK_DEVICE", "cpu")
+TRANSLATOR_RELOAD_COOLDOWN = float(os.getenv("TRANSLATOR_RELOAD_COOLDOWN", "30"))
+# warm every replica with the batch shapes and beams the decoding policy produces before serving
+TRANSLATOR_WARMUP = os.getenv("TRANSLATOR_WARMUP", "1").lower() in ("1", "true", "yes")
+
+# autotune: benchmark compute_type/threads/batch size once per host and keep the winner in a JSON profile
+TRANSLATOR_PROFILE = os.getenv("TRANSLATOR_PROFILE", "./translator_profile.json")
+TRANSLATOR_AUTOTUNE = os.getenv("TRANSLATOR_AUTOTUNE", "0").lower() in ("1", "true", "yes")
+AUTOTUNE_ROUNDS = int(os.getenv("AUTOTUNE_ROUNDS", "3"))
+AUTOTUNE_QUALITY_TOLERANCE = float(os.getenv("AUTOTUNE_QUALITY_TOLERANCE", "0.05"))
+
+# load-adaptive decoding: beam search drops to a smaller beam, then to greedy, as the translation
+# queue grows, and comes back once the queue has drained below half of each threshold
+DECODE_QUEUE_REDUCED = int(os.getenv("DECODE_QUEUE_REDUCED", "16"))
+DECODE_QUEUE_GREEDY = int(os.getenv("DECODE_QUEUE_GREEDY", "64"))
+DECODE_SHORT_WORDS = int(os.getenv("DECODE_SHORT_WORDS", "4"))
+# beam patience at full beam on an idle queue; lets longer messages explore more hypotheses
+DECODE_PATIENCE = float(os.getenv("DECODE_PATIENCE", "2.0"))
+DECODE_LENGTH_RATIO = float(os.getenv("DECODE_LENGTH_RATIO", "2.0"))
+DECODE_MAX_LENGTH = int(os.getenv("DECODE_MAX_LENGTH", "256"))
+# two-pass decoding: every sentence is decoded greedily first and only those whose length-normalized
+# log-probability is below the threshold are decoded again with the chosen beam
+TRANSLATE_TWO_PASS = os.getenv("TRANSLATE_TWO_PASS", "0").lower() in ("1", "true", "yes")
+TWO_PASS_THRESHOLD = float(os.getenv("TWO_PASS_THRESHOLD", "-0.5"))
+
+# micro-batching: requests arriving within the window are merged into one translate_batch call
+TRANSLATE_BATCH_WINDOW_MS = float(os.getenv("TRANSLATE_BATCH_WINDOW_MS", "5"))
+TRANSLATE_MAX_BATCH = int(os.getenv("TRANSLATE_MAX_BATCH", "32"))
+TRANSLATE_MAX_BATCH_TOKENS = int(os.getenv("TRANSLATE_MAX_BATCH_TOKENS", "4096"))
+
+# Fa->En result cache (entries=0 disables it)
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "2048"))
+TRANSLATION_CACHE_TTL = float(os.getenv("TRANSLATION_CACHE_TTL", "3600"))
+
+# Ollama response cache (0 entries disables it): first turns, or any turn at or below the temperature
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "0"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600"))
+RESPONSE_CACHE_MAX_TEMPERATURE = float(os.getenv("RESPONSE_CACHE_MAX_TEMPERATURE", "0"))
+
+# also translate Persian comments inside fenced code blocks (code itself is never translated)
+TRANSLATE_CODE_COMMENTS = os.getenv("TRANSLATE_CODE_COMMENTS", "0").lower() in ("1", "true", "yes")
+
+# conversation store limits (0 disables a limit)
+CONV_MAX_SESSIONS = int(os.getenv("CONV_MAX_SESSIONS", "10000"))
+CONV_MAX_MESSAGES = int(os.getenv("CONV_MAX_MESSAGES", "200"))
+CONV_MAX_BYTES = int(os.getenv("CONV_MAX_BYTES", str(256 * 1024)))
+CONV_IDLE_TTL = float(os.getenv("CONV_IDLE_TTL", str(6 * 3600)))
+CONV_SWEEP_INTERVAL = float(os.getenv("CONV_SWEEP_INTERVAL", "60"))
+
+# prompt context budget sent to Ollama (tokens); per-model overrides as JSON {"model": budget}
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4096"))
+CONTEXT_TOKEN_BUDGETS = json.loads(os.getenv("CONTEXT_TOKEN_BUDGETS", "{}") or "{}")
+# "estimate" (chars / CONTEXT_CHARS_PER_TOKEN) or "sentencepiece" (the MT model's tokenizer)
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "estimate").lower()
+CONTEXT_CHARS_PER_TOKEN = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", "3.5"))
+CONTEXT_MESSAGE_OVERHEAD = int(os.getenv("CONTEXT_MESSAGE_OVERHEAD", "4"))
+CONTEXT_MIN_TRIM_TOKENS = int(os.getenv("CONTEXT_MIN_TRIM_TOKENS", "64"))
+# when the window must slide, refill it only to this share of the budget so later turns can extend it
+CONTEXT_REFILL_RATIO = float(os.getenv("CONTEXT_REFILL_RATIO", "0.75"))
+
+# session backend: "memory" (single worker) or "sqlite" (shared by all workers on one host)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory").lower()
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "./sessions.db")
+SESSION_FLUSH_INTERVAL_MS = float(os.getenv("SESSION_FLUSH_INTERVAL_MS", "50"))
+
+# admission control for chat requests: concurrency limits plus a bounded, time-limited wait queue;
+# beyond that requests get 429 with Retry-After instead of piling up until they all time out
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "16"))
+ADMISSION_MAX_PER_SESSION = int(os.getenv("ADMISSION_MAX_PER_SESSION", "2"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_MAX_WAIT_SEC = float(os.getenv("ADMISSION_MAX_WAIT_SEC", "10"))
+
+# sentence-level translation store shared by all workers ("" disables it)
+SEGMENT_STORE_PATH = os.getenv("SEGMENT_STORE_PATH", "./translation_segments.db")
+
 translator = None
 sp = None
+segment_store = None
+ollama_client: httpx.AsyncClient | None = None
 
 # ---------------- utils ----------------
 def find_spm(model_dir):
@@ -64,111 +208,2397 @@ def detokenize_clean(sp_proc, pieces):
     text = re.sub(r"\s+'(\w)", r"'\1", text)
     return text.strip()
 
+# ---------------- metrics ----------------
+# Prometheus text exposition without a client library: a lock and a few list updates per sample
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+request_endpoint = contextvars.ContextVar("request_endpoint", default="other")
+
+def _label_str(pairs):
+    if not pairs:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+def _value_str(v):
+    v = float(v)
+    return str(int(v)) if v.is_integer() else repr(v)
+
+class Metric:
+    """Base for labelled series. Label values past `max_series` are folded into "other"."""
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=(), max_series=200):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.max_series = max_series
+        self._series: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _key(self, labels):
+        if labels in self._series or len(self._series) < self.max_series:
+            return labels
+        return ("other",) * len(labels)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, list(zip(self.label_names, k)), v) for k, v in self._series.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{_label_str(pairs)} {_value_str(value)}" for name, pairs, value in self.samples()]
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, value=1.0):
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0.0) + value
+
+class Gauge(Metric):
+    """Set/inc/dec gauge, or with `fn` a callback read at scrape time (no labels)."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def inc(self, *labels, value=1.0):
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0.0) + value
+
+    def dec(self, *labels, value=1.0):
+        self.inc(*labels, value=-value)
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._series[self._key(labels)] = float(value)
+
+    def samples(self):
+        if self.fn is None:
+            return super().samples()
+        try:
+            return [(self.name, [], float(self.fn()))]
+        except Exception:
+            return []
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(labels)
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        out = []
+        with self._lock:
+            items = [(k, list(c), s, n) for k, (c, s, n) in self._series.items()]
+        for key, counts, total, n in items:
+            pairs = list(zip(self.label_names, key))
+            cum = 0
+            for le, c in zip(self.buckets + (float("inf"),), counts):
+                cum += c
+                out.append((self.name + "_bucket", pairs + [("le", "+Inf" if le == float("inf") else f"{le:g}")], cum))
+            out.append((self.name + "_sum", pairs, total))
+            out.append((self.name + "_count", pairs, n))
+        return out
+
+METRICS: list = []
+
+def render_metrics():
+    lines = []
+    for m in METRICS:
+        lines += m.render()
+    return "\n".join(lines) + "\n"
+
+MT_MODEL_LABEL = os.path.basename(os.path.normpath(MODEL_DIR))
+STAGE_SECONDS = Histogram("translation_stage_seconds", "Time per translation pipeline stage.", ["stage"])
+BATCH_SIZE = Histogram("translate_batch_size", "Sentences per translate_batch call.", [],
+                       buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+BATCH_TOKENS = Histogram("translate_batch_tokens", "Source tokens per translate_batch call.", [],
+                         buckets=(16, 64, 256, 1024, 4096, 16384))
+OLLAMA_SECONDS = Histogram("ollama_request_seconds", "Ollama round trip, until the last token.", ["endpoint", "model"])
+OLLAMA_FIRST_TOKEN = Histogram("ollama_first_token_seconds", "Time to the first streamed token.", ["model"])
+OLLAMA_PROMPT_EVAL = Histogram("ollama_prompt_eval_seconds", "Prompt evaluation reported by Ollama.", ["model"])
+OLLAMA_PROMPT_TOKENS = Histogram("ollama_prompt_eval_tokens", "Prompt tokens Ollama evaluated (not served from its cache).",
+                                 ["model"], buckets=(0, 16, 64, 256, 512, 1024, 2048, 4096, 8192))
+OLLAMA_LOAD = Histogram("ollama_load_seconds", "Model load time reported by Ollama; non-zero means a cold start.", ["model"])
+HTTP_SECONDS = Histogram("http_request_seconds", "HTTP request duration, including streamed bodies.", ["endpoint"])
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests by status code.", ["endpoint", "status"])
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being served.", ["endpoint"])
+ERRORS = Counter("errors_total", "Failures by endpoint, model and kind.", ["endpoint", "model", "kind"])
+OLLAMA_BREAKER = Gauge("ollama_breaker_state", "Circuit breaker per Ollama host: 0 closed, 1 half-open, 2 open.", ["host"])
+OLLAMA_BREAKER_TRANSITIONS = Counter("ollama_breaker_transitions_total", "Circuit breaker state changes.", ["host", "state"])
+OLLAMA_RETRIES_TOTAL = Counter("ollama_retries_total", "Chat calls re-sent after a connection failure.", ["model"])
+OLLAMA_HEDGES = Counter("ollama_hedges_total", "Hedged duplicate calls: sent, and won by the duplicate.", ["model", "outcome"])
+Gauge("translation_queue_depth", "Sentences waiting in the translation batcher.", fn=lambda: batcher.qsize())
+Gauge("translation_batches_running", "Batches dispatched to the translator pool.", fn=lambda: batcher._running)
+Gauge("translator_busy_slots", "Translator pool slots running a batch.",
+      fn=lambda: sum(st["in_flight"] for st in translator._stats) if translator is not None else 0)
+Gauge("admission_active", "Chat requests holding an admission slot.", fn=lambda: admission.active)
+Gauge("admission_queued", "Chat requests waiting for an admission slot.", fn=lambda: len(admission._waiters))
+
+class MetricsMiddleware:
+    """ASGI middleware: per-endpoint latency, status and in-flight counts; sets request_endpoint."""
+
+    def __init__(self, app):
+        self.app = app
+        self.paths = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if self.paths is None:
+            self.paths = {getattr(r, "path", None) for r in scope["app"].routes}
+        # unknown paths share one label so scanners can't blow up the series count
+        endpoint = scope["path"] if scope["path"] in self.paths else "other"
+        token = request_endpoint.set(endpoint)
+        status = 500
+        t0 = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(endpoint)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec(endpoint)
+            HTTP_SECONDS.observe(time.perf_counter() - t0, endpoint)
+            HTTP_REQUESTS.inc(endpoint, str(status))
+            request_endpoint.reset(token)
+
+app.add_middleware(MetricsMiddleware)
+
+# ---------------- request tracing ----------------
+# every request gets an ID (logged and returned as X-Request-ID) and a per-stage timing trace that is
+# returned as a Server-Timing header, and in the JSON body with ?timings=1
+request_id = contextvars.ContextVar("request_id", default=None)
+request_trace = contextvars.ContextVar("request_trace", default=None)
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+def trace_add(stage, seconds):
+    trace = request_trace.get()
+    if trace is not None:
+        trace[stage] = trace.get(stage, 0.0) + seconds
+
+def trace_max(stage, seconds):
+    # for stages that overlap across the concurrent sentences of one request
+    trace = request_trace.get()
+    if trace is not None:
+        trace[stage] = max(trace.get(stage, 0.0), seconds)
+
+def trace_snapshot():
+    """Stage timings of the current request in milliseconds."""
+    return {k: round(v * 1000, 2) for k, v in (request_trace.get() or {}).items()}
+
+def server_timing(trace, total):
+    parts = [f"{k};dur={v * 1000:.1f}" for k, v in trace.items()]
+    return ", ".join(parts + [f"total;dur={total * 1000:.1f}"])
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        rid = request_id.get()
+        if rid and not hasattr(record, "request_id"):
+            record.request_id = rid
+            record.msg = f"[{rid}] {record.msg}"
+        return True
+
+logger.addFilter(RequestIdFilter())
+
+class RequestTraceMiddleware:
+    """ASGI middleware: assigns the request ID and trace, and adds X-Request-ID and Server-Timing."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        incoming = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")
+        rid = incoming if _REQUEST_ID_RE.match(incoming) else uuid.uuid4().hex[:16]
+        trace = {}
+        tokens = request_id.set(rid), request_trace.set(trace)
+        t0 = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                # streamed responses only carry the stages finished before the body starts
+                headers = list(message.get("headers", []))
+                headers.append((b"x-request-id", rid.encode("latin-1")))
+                headers.append((b"server-timing", server_timing(trace, time.perf_counter() - t0).encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id.reset(tokens[0])
+            request_trace.reset(tokens[1])
+
+app.add_middleware(RequestTraceMiddleware)
+
+def wants_timings(request):
+    return request.query_params.get("timings", "").lower() in ("1", "true", "yes")
+
+def ollama_timings(data, total, model=None):
+    """Split an Ollama round trip into prompt eval and generation when the reply has durations (ns)."""
+    pe, ev = data.get('prompt_eval_duration'), data.get('eval_duration')
+    if model:
+        if isinstance(pe, (int, float)):
+            OLLAMA_PROMPT_EVAL.observe(pe / 1e9, model)
+        if isinstance(data.get('prompt_eval_count'), int):
+            OLLAMA_PROMPT_TOKENS.observe(data['prompt_eval_count'], model)
+        if isinstance(data.get('load_duration'), (int, float)):
+            OLLAMA_LOAD.observe(data['load_duration'] / 1e9, model)
+    if isinstance(pe, (int, float)) and isinstance(ev, (int, float)):
+        trace_add('ollama_prompt', pe / 1e9)
+        trace_add('ollama_gen', ev / 1e9)
+        trace_add('ollama_other', max(0.0, total - (pe + ev) / 1e9))
+    else:
+        trace_add('ollama', total)
+
+def json_with_timings(request, content):
+    if wants_timings(request):
+        content['timings'] = trace_snapshot()
+    t0 = time.perf_counter()
+    resp = JSONResponse(content)
+    trace_add('serialize', time.perf_counter() - t0)
+    return resp
+
+# ---------------- translator pool ----------------
+class TranslatorPool:
+    """Replicas of the ctranslate2 model behind a dedicated, bounded executor.
+
+    Every replica offers inter_threads slots; a batch is dispatched to an idle slot and waits
+    for one otherwise, so the executor never queues more work than the model can run.
+    """
+
+    def __init__(self, model_dir=MODEL_DIR, device=None, compute_type=None, replicas=None,
+                 inter_threads=None, intra_threads=None):
+        # unset arguments follow the current settings, which a translator profile may have changed
+        self.model_dir = model_dir
+        self.device = device or TRANSLATOR_DEVICE
+        self.compute_type = compute_type or TRANSLATOR_COMPUTE_TYPE
+        self.replicas = max(1, replicas or TRANSLATOR_REPLICAS)
+        self.inter_threads = max(1, inter_threads or TRANSLATOR_INTER_THREADS)
+        intra_threads = TRANSLATOR_INTRA_THREADS if intra_threads is None else intra_threads
+        if intra_threads <= 0:
+            intra_threads = max(1, (os.cpu_count() or 1) // (self.replicas * self.inter_threads))
+        self.intra_threads = intra_threads
+        self.models: list = []
+        self._executor: ThreadPoolExecutor | None = None
+        self._idle: asyncio.Queue | None = None
+        self._stats: list[dict] = []
+        self.loaded_at = 0.0
+
+    @property
+    def capacity(self):
+        return len(self.models) * self.inter_threads
+
+    def load(self):
+        """Blocking: load all replicas (raises if the model can't be loaded on this device)."""
+        models = [ctranslate2.Translator(self.model_dir, device=self.device, compute_type=self.compute_type,
+                                         inter_threads=self.inter_threads, intra_threads=self.intra_threads)
+                  for _ in range(self.replicas)]
+        self.models = models
+        self._stats = [{"batches": 0, "items": 0, "busy_sec": 0.0, "in_flight": 0} for _ in models]
+        self._executor = ThreadPoolExecutor(max_workers=self.capacity, thread_name_prefix="ct2")
+        self._idle = None
+        self.loaded_at = time.monotonic()
+        logger.info("Translator pool: %d replica(s) on %s, inter_threads=%d intra_threads=%d compute_type=%s",
+                    self.replicas, self.device, self.inter_threads, self.intra_threads, self.compute_type)
+        return self
+
+    def _slots(self):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for _ in range(self.inter_threads):
+                for i in range(len(self.models)):
+                    self._idle.put_nowait(i)
+        return self._idle
+
+    def _run(self, i, batch, opts):
+        if not self.models:
+            raise RuntimeError("Translator pool closed")
+        st = self._stats[i]
+        t0 = time.perf_counter()
+        try:
+            return self.models[i].translate_batch(batch, **opts)
+        finally:
+            dt = time.perf_counter() - t0
+            st["busy_sec"] += dt
+            st["batches"] += 1
+            st["items"] += len(batch)
+            STAGE_SECONDS.observe(dt, "translate_batch")
+            BATCH_SIZE.observe(len(batch))
+            BATCH_TOKENS.observe(sum(map(len, batch)))
+
+    def translate_batch_sync(self, batch, replica=0, **opts):
+        return self._run(replica, batch, opts)
+
+    async def translate_batch(self, batch, **opts):
+        slots = self._slots()
+        i = await slots.get()
+        self._stats[i]["in_flight"] += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._run, i, batch, opts)
+        finally:
+            self._stats[i]["in_flight"] -= 1
+            slots.put_nowait(i)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self.models = []
+
+    def stats(self):
+        uptime = max(1e-9, time.monotonic() - self.loaded_at)
+        return {
+            "device": self.device,
+            "compute_type": self.compute_type,
+            "inter_threads": self.inter_threads,
+            "intra_threads": self.intra_threads,
+            "idle_slots": self._idle.qsize() if self._idle is not None else self.capacity,
+            "replicas": [dict(st, busy_sec=round(st["busy_sec"], 3),
+                              # busy time per slot, so 1.0 means every slot of the replica was always busy
+                              utilization=round(st["busy_sec"] / (uptime * self.inter_threads), 4))
+                         for st in self._stats],
+        }
+
+# ---------------- autotune ----------------
+AUTOTUNE_SAMPLES = [
+    "سلام",
+    "چطور می‌توانم یک فایل JSON را در پایتون بخوانم؟",
+    "این تابع را طوری بازنویسی کن که سریع‌تر اجرا شود.",
+    "خطای «ModuleNotFoundError» یعنی چه و چطور رفعش کنم؟",
+    "یک کلاس برای مدیریت اتصال به پایگاه داده بنویس که در صورت قطع شدن دوباره وصل شود.",
+    "تفاوت بین لیست و تاپل در پایتون چیست؟",
+    "لطفاً این کد را توضیح بده و بگو چه مشکلی دارد.",
+    "می‌خواهم یک API ساده با FastAPI بسازم که فایل آپلود کند و اندازه‌اش را برگرداند.",
+    "چرا برنامه من بعد از چند ساعت کار کردن حافظه زیادی مصرف می‌کند؟",
+    "ممنون، خیلی کمک کرد.",
+    "یک اسکریپت bash بنویس که همه فایل‌های لاگ قدیمی‌تر از هفت روز را پاک کند و نتیجه را گزارش دهد.",
+    "در جاوااسکریپت چطور می‌توانم چند درخواست را به صورت همزمان ارسال کنم و منتظر همه آن‌ها بمانم؟",
+]
+
+def host_fingerprint():
+    return {"machine": platform.machine(), "cpus": os.cpu_count() or 1, "model_dir": os.path.abspath(MODEL_DIR),
+            "ctranslate2": getattr(ctranslate2, "__version__", "")}
+
+def _ngram_f1(hyp, ref, n=3):
+    # character n-gram F1, a cheap stand-in for chrF when comparing against the float32 reference
+    grams = lambda t: {t[i:i + n] for i in range(max(1, len(t) - n + 1))}
+    h, r = grams(hyp), grams(ref)
+    if not h or not r:
+        return float(hyp == ref)
+    overlap = len(h & r)
+    return 0.0 if overlap == 0 else 2 * overlap / (len(h) + len(r))
+
+def _autotune_candidates(device):
+    supported = set(ctranslate2.get_supported_compute_types(device))
+    wanted = ["int8", "int8_float32", "float32"] + (["int8_float16", "float16"] if device == "cuda" else [])
+    cores = os.cpu_count() or 1
+    threads = [(inter, max(1, cores // inter)) for inter in (1, 2, 4) if inter <= cores]
+    return [(ct, inter, intra) for ct in wanted if ct in supported for inter, intra in threads]
+
+def _bench(model, sp_model, batches, inter_threads, max_batch_size):
+    # keep every inter_threads worker busy, like the translator pool does under load
+    outputs = [None] * len(batches)
+    def work(i):
+        res = model.translate_batch(batches[i], beam_size=BEAM, max_batch_size=max_batch_size)
+        outputs[i] = [detokenize_clean(sp_model, r.hypotheses[0]) for r in res]
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=inter_threads) as ex:
+        list(ex.map(work, range(len(batches))))
+    return time.perf_counter() - t0, [o for out in outputs for o in out]
+
+def autotune_translator(device=None, rounds=AUTOTUNE_ROUNDS, tolerance=AUTOTUNE_QUALITY_TOLERANCE, path=TRANSLATOR_PROFILE):
+    """Blocking: time every candidate config on AUTOTUNE_SAMPLES and persist the fastest acceptable one."""
+    device = device or TRANSLATOR_DEVICE
+    if device == "auto":
+        device = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+    sp_local = sp or load_sp(MODEL_DIR)
+    tokens = [encode_text(sp_local, t) for t in AUTOTUNE_SAMPLES]
+    cores = os.cpu_count() or 1
+
+    ref_model = ctranslate2.Translator(MODEL_DIR, device=device, compute_type="float32", intra_threads=cores)
+    reference = [detokenize_clean(sp_local, r.hypotheses[0]) for r in ref_model.translate_batch(tokens, beam_size=BEAM)]
+    del ref_model
+
+    results = []
+    for compute_type, inter, intra in _autotune_candidates(device):
+        try:
+            model = ctranslate2.Translator(MODEL_DIR, device=device, compute_type=compute_type,
+                                           inter_threads=inter, intra_threads=intra)
+        except Exception as e:
+            logger.warning("Autotune: skipping %s inter=%d intra=%d (%s)", compute_type, inter, intra, e)
+            continue
+        for max_batch in (8, 32):
+            batches = [tokens[i:i + max_batch] for i in range(0, len(tokens), max_batch)] * rounds
+            _bench(model, sp_local, batches[:1], inter, max_batch)  # warm caches/allocators
+            elapsed, outputs = _bench(model, sp_local, batches, inter, max_batch)
+            quality = sum(_ngram_f1(o, r) for o, r in zip(outputs, reference * rounds)) / len(outputs)
+            results.append({"compute_type": compute_type, "inter_threads": inter, "intra_threads": intra,
+                            "max_batch_size": max_batch, "sentences_per_sec": round(len(outputs) / elapsed, 2),
+                            "quality": round(quality, 4)})
+            logger.info("Autotune: %s", results[-1])
+        del model
+
+    if not results:
+        raise RuntimeError("autotune: no candidate configuration could be loaded")
+    acceptable = [r for r in results if r["quality"] >= 1.0 - tolerance]
+    if not acceptable:
+        # never trade quality for speed: fall back to the float32 reference config
+        logger.warning("Autotune: no candidate within quality tolerance %.3f; using float32", tolerance)
+        acceptable = [r for r in results if r["compute_type"] == "float32"] or [
+            {"compute_type": "float32", "inter_threads": 1, "intra_threads": cores, "max_batch_size": 32,
+             "sentences_per_sec": None, "quality": 1.0}]
+    best = max(acceptable, key=lambda r: r["sentences_per_sec"])
+    profile = {"host": host_fingerprint(), "device": device, "best": best, "results": results,
+               "created": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(profile, f, ensure_ascii=False, indent=2)
+    logger.info("Autotune picked %s", best)
+    return profile
+
+def load_translator_profile(path=TRANSLATOR_PROFILE):
+    if not path or not os.path.isfile(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            profile = json.load(f)
+    except Exception as e:
+        logger.warning("Ignoring unreadable translator profile %s: %s", path, e)
+        return None
+    if profile.get("host") != host_fingerprint():
+        logger.info("Translator profile %s was tuned on another host/model; ignoring it.", path)
+        return None
+    return profile
+
+def apply_translator_profile(profile):
+    """Use the tuned values for every setting that wasn't set explicitly in the environment."""
+    global TRANSLATOR_COMPUTE_TYPE, TRANSLATOR_INTER_THREADS, TRANSLATOR_INTRA_THREADS
+    best = profile["best"]
+    if "TRANSLATOR_COMPUTE_TYPE" not in os.environ:
+        TRANSLATOR_COMPUTE_TYPE = best["compute_type"]
+    if "TRANSLATOR_INTER_THREADS" not in os.environ:
+        TRANSLATOR_INTER_THREADS = best["inter_threads"]
+    if "TRANSLATOR_INTRA_THREADS" not in os.environ:
+        TRANSLATOR_INTRA_THREADS = best["intra_threads"]
+    if "TRANSLATE_MAX_BATCH" not in os.environ:
+        batcher.max_batch = best["max_batch_size"]
+    logger.info("Using translator profile: compute_type=%s inter=%d intra=%d max_batch=%d",
+                TRANSLATOR_COMPUTE_TYPE, TRANSLATOR_INTER_THREADS, TRANSLATOR_INTRA_THREADS, batcher.max_batch)
+
+# ---------------- translation batcher ----------------
+class TranslationBatcher:
+    """Collects concurrent translate requests and runs them as a single translate_batch call.
+
+    A batch is closed when the window expires, when max_batch items are queued or when the
+    token budget is reached. Items with different decoding options are run as separate groups.
+    """
+
+    def __init__(self, window_ms=TRANSLATE_BATCH_WINDOW_MS, max_batch=TRANSLATE_MAX_BATCH,
+                 max_tokens=TRANSLATE_MAX_BATCH_TOKENS):
+        self.window = max(0.0, window_ms) / 1000.0
+        self.max_batch = max(1, max_batch)
+        self.max_tokens = max(1, max_tokens)
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self._carry = None
+        self._running = 0
+        self._slot_freed: asyncio.Condition | None = None
+        self._started: dict = {}  # future -> time its batch was dispatched
+        self.batches = 0
+        self.items = 0
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._carry = None
+            self._running = 0
+            self._slot_freed = asyncio.Condition()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        pending = [self._carry] if self._carry else []
+        self._carry = None
+        while self._queue is not None and not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        for _, _, fut in pending:
+            if not fut.done():
+                fut.set_exception(RuntimeError("translation batcher stopped"))
+
+    def qsize(self):
+        return (self._queue.qsize() if self._queue is not None else 0) + (1 if self._carry else 0)
+
+    async def submit(self, tokens, **opts):
+        """Queue one tokenized sentence; returns its ctranslate2 TranslationResult."""
+        self.start()
+        fut = asyncio.get_running_loop().create_future()
+        t0 = time.perf_counter()
+        await self._queue.put((list(tokens), opts, fut))
+        try:
+            return await fut
+        finally:
+            started = self._started.pop(fut, None)
+            if started is not None:
+                trace_max("mt_queue", started - t0)
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        if self._carry is not None:
+            first, self._carry = self._carry, None
+        else:
+            first = await self._queue.get()
+        batch, ntok = [first], len(first[0])
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch and ntok < self.max_tokens:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if ntok + len(item[0]) > self.max_tokens:
+                self._carry = item
+                break
+            batch.append(item)
+            ntok += len(item[0])
+        return batch
+
+    async def _run(self):
+        while True:
+            # one batch in flight per free pool slot; while all slots are busy, requests keep
+            # accumulating in the queue and go out together as the next (larger) batch
+            async with self._slot_freed:
+                await self._slot_freed.wait_for(lambda: self._running < max(1, getattr(translator, "capacity", 1)))
+            batch = await self._collect()
+            groups: dict[tuple, list] = {}
+            for item in batch:
+                if item[2].done():  # caller went away while queued
+                    continue
+                # max_decoding_length differs per sentence; it must not split batches
+                key = tuple(sorted((k, v) for k, v in item[1].items() if k != "max_decoding_length"))
+                groups.setdefault(key, []).append(item)
+            if groups:
+                self._running += 1
+                asyncio.create_task(self._run_groups(list(groups.values())))
+
+    async def _run_groups(self, groups):
+        try:
+            for items in groups:
+                await self._run_group(items)
+        finally:
+            self._running -= 1
+            async with self._slot_freed:
+                self._slot_freed.notify_all()
+
+    async def _run_group(self, items):
+        tr = translator
+        try:
+            if tr is None:
+                raise RuntimeError("Translator not available")
+            opts = dict(items[0][1])
+            lengths = [i[1]["max_decoding_length"] for i in items if "max_decoding_length" in i[1]]
+            if lengths:
+                opts["max_decoding_length"] = max(lengths)
+            now = time.perf_counter()
+            for _, _, fut in items:
+                if not fut.done():
+                    self._started[fut] = now
+            results = await tr.translate_batch([i[0] for i in items], **opts)
+        except Exception as e:
+            for _, _, fut in items:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        self.batches += 1
+        self.items += len(items)
+        for (_, _, fut), res in zip(items, results):
+            if not fut.done():
+                fut.set_result(res)
+
+    def stats(self):
+        return {
+            "queued": self.qsize(),
+            "running": self._running,
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+        }
+
+batcher = TranslationBatcher()
+
+# ---------------- message segmentation ----------------
+# fenced blocks (an unclosed fence runs to the end of the message) and `inline code`
+_CODE_SPAN_RE = re.compile(r"```.*?(?:```|\Z)|~~~.*?(?:~~~|\Z)|`[^`\n]+`", re.S)
+_FA_RE = re.compile(r"[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF\uFB50-\uFDFF\uFE70-\uFEFF]")
+# line comments (#, //, --) that contain Persian text
+_FA_COMMENT_RE = re.compile(r"((?:^|[ \t])(?:#|//|--)[ \t]*)([^\n]*[\u0600-\u06FF][^\n]*?)([ \t]*)$", re.M)
+_FA_CHAR_MAP = str.maketrans({"\u064A": "\u06CC", "\u0643": "\u06A9", "\u200F": None, "\u200E": None})
+
+def _split_comments(code):
+    segments, pos = [], 0
+    for m in _FA_COMMENT_RE.finditer(code):
+        segments.append(("code", code[pos:m.start(2)]))
+        segments.append(("comment", m.group(2)))
+        pos = m.end(2)
+    segments.append(("code", code[pos:]))
+    return [seg for seg in segments if seg[1]]
+
+def segment_message(text, translate_comments=None):
+    """Split a message into ("prose" | "code" | "comment", text) spans that concatenate back to it."""
+    if translate_comments is None:
+        translate_comments = TRANSLATE_CODE_COMMENTS
+    segments, pos = [], 0
+    for m in _CODE_SPAN_RE.finditer(text):
+        if m.start() > pos:
+            segments.append(("prose", text[pos:m.start()]))
+        code = m.group(0)
+        if translate_comments and code.startswith(("```", "~~~")):
+            segments.extend(_split_comments(code))
+        else:
+            segments.append(("code", code))
+        pos = m.end()
+    if pos < len(text):
+        segments.append(("prose", text[pos:]))
+    return segments
+
+def needs_translation(kind, text):
+    return kind != "code" and _FA_RE.search(text) is not None
+
+# ---------------- translation cache ----------------
+def normalize_source(text):
+    # whitespace and characters inside code are significant, so only prose is normalized
+    parts = []
+    for kind, span in segment_message(text or "", translate_comments=False):
+        if kind == "prose":
+            span = unicodedata.normalize("NFC", span).translate(_FA_CHAR_MAP)
+            span = re.sub(r"[^\S\n]*\n\s*", "\n", re.sub(r"[^\S\n]+", " ", span))
+        parts.append(span)
+    return "".join(parts).strip()
+
+class TranslationCache:
+    """Bounded LRU/TTL cache with single-flight: concurrent misses on one key share a single decode."""
+
+    def __init__(self, max_entries=TRANSLATION_CACHE_SIZE, ttl=TRANSLATION_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._inflight: dict = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if self.ttl > 0 and expires < time.monotonic():
+            self._data.pop(key, None)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def lookup(self, key):
+        """get() that counts towards the hit/miss stats."""
+        value = self.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def get_or_compute(self, key, factory):
+        return (await self.fetch(key, factory))[0]
+
+    async def fetch(self, key, factory):
+        """get_or_compute that also returns how the value was found: "hit", "miss" or "coalesced"."""
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value, "hit"
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            status = "coalesced"
+        else:
+            self.misses += 1
+            status = "miss"
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._finish(k, t))
+        # shield: one caller disconnecting must not cancel the decode the others are waiting on
+        return await asyncio.shield(task), status
+
+    def _finish(self, key, task):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self.put(key, task.result())
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._data),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+        }
+
+translation_cache = TranslationCache()
+
+# ---------------- decoding policy ----------------
+def decoding_length(n_tokens):
+    return max(16, min(DECODE_MAX_LENGTH, int(n_tokens * DECODE_LENGTH_RATIO) + 10))
+
+class DecodingPolicy:
+    """Picks beam size and patience from message length and translation queue depth.
+
+    Levels: 0 = full beam, 1 = reduced beam, 2 = greedy. The level rises as soon as the queue
+    crosses a threshold and only falls again once the queue is below half of it, so it doesn't
+    flap around a threshold.
+    """
+
+    MODES = ("beam", "reduced", "greedy")
+
+    def __init__(self, beam=BEAM, reduced_at=DECODE_QUEUE_REDUCED, greedy_at=DECODE_QUEUE_GREEDY,
+                 short_words=DECODE_SHORT_WORDS, patience=DECODE_PATIENCE):
+        self.beam = beam
+        self.patience = patience
+        self.reduced_at = reduced_at
+        self.greedy_at = greedy_at
+        self.short_words = short_words
+        self.level = 0
+        self.pending = 0  # translate_text calls in progress, including those not queued yet
+        self.chosen = [0, 0, 0]
+        self.two_pass = [0, 0]  # sentences decoded greedily, of which re-decoded with the beam
+
+    def _update(self, depth):
+        up = 2 if depth >= self.greedy_at else 1 if depth >= self.reduced_at else 0
+        down = 2 if depth > self.greedy_at // 2 else 1 if depth > self.reduced_at // 2 else 0
+        new = max(up, min(self.level, down))
+        if new != self.level:
+            logger.info("Decoding policy: %s -> %s (queue=%d)", self.MODES[self.level], self.MODES[new], depth)
+        self.level = new
+
+    def choose(self, text=""):
+        depth = batcher.qsize() + self.pending
+        self._update(depth)
+        beam = (self.beam, max(1, self.beam // 2), 1)[self.level]
+        # extra patience only pays off at full beam, and only when nothing is waiting behind us
+        patience = self.patience if self.level == 0 and depth == 0 else 1
+        # a handful of words gains almost nothing from a wide beam
+        if len(text.split()) <= self.short_words:
+            beam, patience = min(beam, 2), 1
+        self.chosen[self.level] += 1
+        return {'beam_size': beam, 'patience': patience, 'mode': self.MODES[self.level], 'queue_depth': depth}
+
+    def stats(self):
+        sentences, escalated = self.two_pass
+        return {"mode": self.MODES[self.level], "pending": self.pending, "chosen": dict(zip(self.MODES, self.chosen)),
+                "two_pass": {"enabled": TRANSLATE_TWO_PASS, "threshold": TWO_PASS_THRESHOLD,
+                             "sentences": sentences, "escalated": escalated,
+                             "greedy_hit_rate": round(1 - escalated / sentences, 3) if sentences else None}}
+
+decoding_policy = DecodingPolicy()
+
+# ---------------- translate path ----------------
+def open_segment_store():
+    global segment_store
+    if not SEGMENT_STORE_PATH:
+        logger.info("Segment store disabled (SEGMENT_STORE_PATH is empty).")
+        return
+    if SegmentStore is None:
+        logger.warning("⚠️ Segment store DISABLED: quickmt.store is not importable (%s).",
+                       quickmt_errors.get("the segment store"))
+        return
+    try:
+        segment_store = SegmentStore(SEGMENT_STORE_PATH)
+        logger.info("Segment store opened: %s", SEGMENT_STORE_PATH)
+    except Exception as e:
+        logger.warning("Segment store unavailable (%s); translating without it.", e)
+        segment_store = None
+
+def split_sentences(texts):
+    if TranslatorABC is None:
+        return [[idx, 0, t.strip()] for idx, t in enumerate(texts) if t.strip()]
+    return TranslatorABC._sentence_split(texts)
+
+def join_sentences(sentences, n):
+    if not sentences:
+        return ["" for _ in range(n)]
+    if TranslatorABC is None:
+        joined = ["" for _ in range(n)]
+        for idx, _, t in sentences:
+            joined[idx] = (joined[idx] + " " + t).strip()
+        return joined
+    joined = TranslatorABC._sentence_join(sentences)
+    return joined + ["" for _ in range(n - len(joined))]
+
+def two_pass_enabled(decoding):
+    return TRANSLATE_TWO_PASS and decoding['beam_size'] > 1
+
+async def _decode_two_pass(tokens_list, opts):
+    """Greedy pass for every sentence, then the beam only for the low-confidence ones."""
+    submit = lambda t, **o: batcher.submit(t, max_decoding_length=decoding_length(len(t)), **o)
+    results = list(await asyncio.gather(*[submit(t, beam_size=1, return_scores=True) for t in tokens_list]))
+    # scores are length-normalized log-probabilities (length_penalty=1)
+    low = [i for i, r in enumerate(results) if not r.scores or r.scores[0] < TWO_PASS_THRESHOLD]
+    if low:
+        rescored = await asyncio.gather(*[submit(tokens_list[i], **opts) for i in low])
+        for i, r in zip(low, rescored):
+            results[i] = r
+    decoding_policy.two_pass[0] += len(results)
+    decoding_policy.two_pass[1] += len(low)
+    return results
+
+async def _decode(tokens_list, decoding):
+    opts = {'beam_size': decoding['beam_size'], 'patience': decoding['patience']}
+    for attempt in range(2):
+        tr = translator
+        try:
+            if two_pass_enabled(decoding):
+                return await _decode_two_pass(tokens_list, opts)
+            # IMPORTANT: pass beam_size as keyword so it doesn't become target_prefix
+            return await asyncio.gather(*[batcher.submit(t, max_decoding_length=decoding_length(len(t)), **opts)
+                                          for t in tokens_list])
+        except RuntimeError as e:
+            if attempt:
+                logger.exception("RuntimeError in translate_batch after reload: %s", e)
+                break
+            logger.warning("RuntimeError in translate_batch: %s", e)
+            # one reload for every caller that saw this pool fail; then retry through the batcher
+            if await translator_manager.recover(tr, e) is None:
+                break
+        except Exception:
+            logger.exception("Unexpected translation error.")
+            ERRORS.inc(request_endpoint.get(), MT_MODEL_LABEL, "translate")
+            raise HTTPException(status_code=500, detail="Internal translation error")
+    ERRORS.inc(request_endpoint.get(), MT_MODEL_LABEL, "translate")
+    raise HTTPException(status_code=503, detail="Translation failed (translator unavailable).")
+
+def cached_patience(decoding):
+    """Patience a translation is filed under, in the cache and the segment store.
+
+    Full-beam results share one entry whatever their patience (the policy only raises it while idle),
+    so a busy full-beam or reduced-beam call reuses a translation decoded while the queue was empty.
+    """
+    return None if decoding['beam_size'] >= BEAM else decoding['patience']
+
+async def _translate_units(units, decoding):
+    """Translate a list of prose strings; all their new sentences go to the batcher together."""
+    sentences = split_sentences(units)
+    if not sentences:
+        return ["" for _ in units]
+    store, stored = segment_store, {}
+    namespace = SegmentStore.namespace(MODEL_DIR, beam_size=decoding['beam_size'], patience=cached_patience(decoding),
+                                       two_pass_threshold=TWO_PASS_THRESHOLD if two_pass_enabled(decoding) else None) \
+        if store is not None else None
+    if store is not None:
+        try:
+            stored = await asyncio.to_thread(store.get_many, [s[2] for s in sentences], namespace)
+        except Exception as e:
+            logger.warning("Segment store lookup failed: %s", e)
+
+    # only sentences never seen before are decoded; the batcher runs them as one translate_batch
+    todo = list(dict.fromkeys(s[2] for s in sentences if s[2] not in stored))
+    if todo:
+        t0 = time.perf_counter()
+        tokens = [encode_text(sp, t) for t in todo]
+        t1 = time.perf_counter()
+        STAGE_SECONDS.observe(t1 - t0, "encode_text")
+        trace_add("tokenize", t1 - t0)
+        results = await _decode(tokens, decoding)
+        t0 = time.perf_counter()
+        trace_add("translate", t0 - t1)  # includes mt_queue
+        fresh = [detokenize_clean(sp, r.hypotheses[0]) for r in results]
+        STAGE_SECONDS.observe(time.perf_counter() - t0, "detokenize_clean")
+        trace_add("detokenize", time.perf_counter() - t0)
+        stored.update(zip(todo, fresh))
+        if store is not None:
+            try:
+                await asyncio.to_thread(store.put_many, list(zip(todo, fresh)), namespace)
+            except Exception as e:
+                logger.warning("Segment store write failed: %s", e)
+
+    return join_sentences([[i, p, stored[t]] for i, p, t in sentences], len(units))
+
+async def _translate_uncached(text, decoding):
+    segments = segment_message(text)
+    # code is spliced back verbatim; only Persian prose (and comments, if enabled) is decoded
+    todo = [i for i, (kind, span) in enumerate(segments) if needs_translation(kind, span)]
+    translated = await _translate_units([segments[i][1].strip() for i in todo], decoding) if todo else []
+    out = [span for _, span in segments]
+    for i, en in zip(todo, translated):
+        span = segments[i][1]
+        lead = span[:len(span) - len(span.lstrip())]
+        trail = span[len(span.rstrip()):]
+        out[i] = lead + en + trail
+    return "".join(out).strip()
+
+async def translate_text(text, decoding=None):
+    decoding = decoding or decoding_policy.choose(text)
+    norm = normalize_source(text)
+    if decoding['beam_size'] < BEAM:
+        # a full-beam translation is already cached: better quality at no cost
+        best = translation_cache.get((norm, BEAM, None, MODEL_DIR))
+        if best is not None:
+            translation_cache.hits += 1
+            return best
+    key = (norm, decoding['beam_size'], cached_patience(decoding), MODEL_DIR)
+    decoding_policy.pending += 1
+    try:
+        return await translation_cache.get_or_compute(key, lambda: _translate_uncached(text, decoding))
+    finally:
+        decoding_policy.pending -= 1
+
+# ---------------- ollama client ----------------
+def create_ollama_client():
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(connect=OLLAMA_CONNECT_TIMEOUT, read=OLLAMA_READ_TIMEOUT,
+                              write=OLLAMA_WRITE_TIMEOUT, pool=OLLAMA_POOL_TIMEOUT),
+        limits=httpx.Limits(max_connections=OLLAMA_MAX_CONNECTIONS,
+                            max_keepalive_connections=OLLAMA_MAX_KEEPALIVE,
+                            keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY),
+        headers={'Content-Type': 'application/json'},
+    )
+
+def get_ollama_client():
+    global ollama_client
+    if ollama_client is None or ollama_client.is_closed:
+        ollama_client = create_ollama_client()
+    return ollama_client
+
+async def close_ollama_client():
+    global ollama_client
+    client, ollama_client = ollama_client, None
+    if client is not None:
+        await client.aclose()
+
+# ---------------- ollama upstream pool ----------------
+def model_key(name):
+    name = (name or "").strip()
+    return name if ":" in name else name + ":latest"
+
+def is_host_failure(error):
+    # 4xx means the request was bad, not the host
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+class OllamaUnavailable(Exception):
+    """No Ollama host can take the call now: every circuit breaker is open, or the model is still provisioning."""
+
+    def __init__(self, retry_after, detail="all Ollama hosts are failing"):
+        super().__init__(f"{detail}, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class OllamaHost:
+    def __init__(self, base):
+        self.base = base
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0  # consecutive
+        self.breaker = "closed"
+        self.open_until = 0.0
+        self.trial = False  # the half-open trial call is in flight
+        self.loaded: set = set()  # models in memory (/api/ps)
+        self.available: set = set()  # models on disk (/api/tags)
+        OLLAMA_BREAKER.set(base, value=0)
+
+    def set_breaker(self, state):
+        if state != self.breaker:
+            self.breaker = state
+            OLLAMA_BREAKER.set(self.base, value=BREAKER_STATES[state])
+            OLLAMA_BREAKER_TRANSITIONS.inc(self.base, state)
+
+    def breaker_state(self):
+        if self.breaker == "open" and time.monotonic() >= self.open_until:
+            self.set_breaker("half_open")
+        return self.breaker
+
+    @property
+    def ejected(self):
+        """No calls go here: breaker open, or half-open with its one trial call already running."""
+        state = self.breaker_state()
+        return state == "open" or (state == "half_open" and self.trial)
+
+    def stats(self):
+        return {"outstanding": self.outstanding, "requests": self.requests, "failures": self.failures,
+                "breaker": self.breaker_state(), "loaded": sorted(self.loaded)}
+
+class OllamaLease:
+    """One call's hold on a host, from acquire() to release(); `trial` marks the half-open trial call."""
+
+    __slots__ = ("host", "trial")
+
+    def __init__(self, host, trial=False):
+        self.host = host
+        self.trial = trial
+
+    @property
+    def base(self):
+        return self.host.base
+
+class OllamaPool:
+    """Routes chat calls across Ollama hosts.
+
+    A call goes to the live host with the fewest outstanding requests among those that have the model
+    loaded (else on disk, else any). A session stays on its previous host while that host has at most
+    `affinity_slack` more outstanding requests than the best one, so the host's prompt cache is reused.
+
+    Each host has a circuit breaker: `eject_after` failed calls in a row, or a failed health check, open
+    it and the host is skipped for `eject_sec`. Then it is half-open: one trial call goes through, and
+    its outcome closes the breaker or opens it again. With every breaker open, calls fail fast with
+    OllamaUnavailable instead of waiting out a timeout.
+    """
+
+    def __init__(self, bases=OLLAMA_HOSTS, interval=OLLAMA_HEALTH_INTERVAL, eject_after=OLLAMA_EJECT_AFTER,
+                 eject_sec=OLLAMA_EJECT_SEC, affinity_slack=OLLAMA_AFFINITY_SLACK, max_sessions=CONV_MAX_SESSIONS):
+        self.hosts = [OllamaHost(b) for b in bases]
+        self.interval = interval
+        self.eject_after = max(1, eject_after)
+        self.eject_sec = eject_sec
+        self.affinity_slack = affinity_slack
+        self.max_sessions = max_sessions
+        self._affinity: OrderedDict = OrderedDict()
+        self._task: asyncio.Task | None = None
+
+    def pick(self, model, session_id=None, avoid=()):
+        model = model_key(model)
+        live = [h for h in self.hosts if not h.ejected]
+        if not live:
+            raise OllamaUnavailable(max(1.0, min(h.open_until for h in self.hosts) - time.monotonic()))
+        live = [h for h in live if h not in avoid] or live
+        candidates = ([h for h in live if model in h.loaded] or [h for h in live if model in h.available]
+                      or live)
+        best = min(candidates, key=lambda h: (h.outstanding, h.requests))
+        if session_id:
+            prev = self._affinity.get(session_id)
+            if prev in candidates and prev.outstanding <= best.outstanding + self.affinity_slack:
+                best = prev
+            self._affinity[session_id] = best
+            self._affinity.move_to_end(session_id)
+            while len(self._affinity) > self.max_sessions:
+                self._affinity.popitem(last=False)
+        return best
+
+    def acquire(self, model, session_id=None, avoid=()):
+        """Pick a host and return an OllamaLease for it; release() it when the call ends."""
+        host = self.pick(model, session_id, avoid)
+        trial = host.breaker == "half_open"
+        if trial:
+            host.trial = True  # no other call goes here until this one settles the breaker
+        host.outstanding += 1
+        host.requests += 1
+        return OllamaLease(host, trial)
+
+    def release(self, lease, error=None):
+        """End a call; errors that say nothing about the host (4xx, cancellation) leave the breaker alone.
+
+        Only the lease taken as the half-open trial decides the breaker alone; calls that started
+        before the breaker opened count like any other.
+        """
+        host, trial = lease.host, lease.trial
+        host.outstanding -= 1
+        if trial:
+            host.trial = False
+        if error is None:
+            host.failures = 0
+            if host.breaker != "closed":
+                logger.info("Ollama host %s recovered", host.base)
+                host.set_breaker("closed")
+        elif is_host_failure(error):
+            host.failures += 1
+            if trial or host.failures >= self.eject_after:
+                self._trip(host, error)
+
+    def _trip(self, host, error):
+        if host.breaker != "open":
+            logger.warning("Ollama host %s: circuit open for %.0fs: %s", host.base, self.eject_sec, error)
+        host.open_until = time.monotonic() + self.eject_sec
+        host.set_breaker("open")
+
+    async def check(self, host):
+        client = get_ollama_client()
+        try:
+            ps = await client.get(host.base + "/api/ps", timeout=OLLAMA_CONNECT_TIMEOUT)
+            tags = await client.get(host.base + "/api/tags", timeout=OLLAMA_CONNECT_TIMEOUT)
+            ps.raise_for_status()
+            tags.raise_for_status()
+            host.loaded = {model_key(m.get("name") or m.get("model")) for m in ps.json().get("models", [])}
+            host.available = {model_key(m.get("name") or m.get("model")) for m in tags.json().get("models", [])}
+        except (httpx.HTTPError, ValueError, AttributeError) as e:
+            self._trip(host, e)
+            return
+        if host.breaker_state() == "open":
+            host.set_breaker("half_open")  # answering again: let a trial call decide
+
+    async def _run(self):
+        while True:
+            await asyncio.gather(*(self.check(h) for h in self.hosts))
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self):
+        return {h.base: h.stats() for h in self.hosts}
+
+ollama_pool = OllamaPool()
+
+# ---------------- upstream resilience ----------------
+def is_connect_error(error):
+    # the request never reached Ollama, so sending it again cannot duplicate a generation
+    return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout))
+
+class FirstByteWindow:
+    """Recent time-to-first-byte per model and mode; the hedge deadline is a percentile of it.
+
+    Streamed and non-streamed calls are kept apart: a non-streamed reply only sends its headers once
+    the whole answer is generated, so its "first byte" is the full generation time.
+    """
+
+    def __init__(self, size=OLLAMA_HEDGE_WINDOW, percentile=OLLAMA_HEDGE_PERCENTILE, min_samples=OLLAMA_HEDGE_MIN_SAMPLES):
+        self.size = size
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._samples: dict[tuple, deque] = {}
+
+    def observe(self, model, stream, seconds):
+        self._samples.setdefault((model_key(model), bool(stream)), deque(maxlen=self.size)).append(seconds)
+
+    def deadline(self, model, stream):
+        samples = self._samples.get((model_key(model), bool(stream)))
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+
+    def stats(self):
+        return {f"{m} ({'stream' if st else 'full'})": {"samples": len(s), "deadline": self.deadline(m, st)}
+                for (m, st), s in self._samples.items()}
+
+first_byte = FirstByteWindow()
+
+async def send_to_host(lease, payload):
+    """POST a chat payload to a leased host and return once the response headers arrive (body unread).
+
+    On failure the lease is released with the error; on success the caller owns the response and the lease.
+    """
+    client = get_ollama_client()
+    try:
+        r = await client.send(client.build_request('POST', lease.base + OLLAMA_CHAT_PATH, json=payload), stream=True)
+    except BaseException as e:
+        ollama_pool.release(lease, e)
+        raise
+    try:
+        r.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        await r.aclose()
+        ollama_pool.release(lease, e)
+        raise
+    return lease, r
+
+def discard_attempt(task):
+    # a hedged attempt that lost the race: close its response; the loss says nothing about the host
+    if task.cancelled() or task.exception() is not None:
+        return
+    lease, r = task.result()
+    ollama_pool.release(lease, asyncio.CancelledError())
+    asyncio.create_task(r.aclose())
+
+async def hedged_send(payload, session_id=None, tried=None):
+    """send_to_host, plus a duplicate to a second host if the first misses the hedge deadline.
+
+    The first successful response wins and the other attempt is cancelled or closed. Hosts in `tried`
+    are avoided, and every host this call sends to is added to it.
+    """
+    model = payload['model']
+    tried = set() if tried is None else tried
+    lease = ollama_pool.acquire(model, session_id, avoid=tried)
+    tried.add(lease.host)
+    deadline = first_byte.deadline(model, payload.get('stream')) if OLLAMA_HEDGE and len(ollama_pool.hosts) > 1 else None
+    if deadline is None:
+        return await send_to_host(lease, payload)
+
+    primary = asyncio.create_task(send_to_host(lease, payload))
+    pending, winner, error = {primary}, None, None
+    try:
+        done, _ = await asyncio.wait(pending, timeout=deadline)
+        if not done:
+            try:
+                backup = ollama_pool.acquire(model, avoid=tried)
+            except OllamaUnavailable:
+                backup = None
+            if backup is not None and backup.host in tried:
+                ollama_pool.release(backup, asyncio.CancelledError())
+            elif backup is not None:
+                tried.add(backup.host)
+                OLLAMA_HEDGES.inc(model, "sent")
+                pending.add(asyncio.create_task(send_to_host(backup, payload)))
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif winner is None:
+                    winner = task.result()
+                    if task is not primary:
+                        OLLAMA_HEDGES.inc(model, "won")
+                else:
+                    discard_attempt(task)
+    finally:
+        for task in pending:
+            task.add_done_callback(discard_attempt)
+            task.cancel()
+    if winner is None:
+        raise error
+    return winner
+
+async def open_ollama(payload, session_id=None):
+    """Send a chat payload upstream; returns (lease, response) with the body unread.
+
+    Only connection failures are retried, on another host when there is one, with full-jitter
+    exponential backoff: the request never reached Ollama then. Timeouts, 5xx and broken streams are not
+    retried, since the model may already have been generating. The caller must close the response and
+    release the lease.
+    """
+    model = payload['model']
+    failed = set()  # hosts this call could not connect to
+    for attempt in range(OLLAMA_RETRIES + 1):
+        t0 = time.perf_counter()
+        try:
+            # a retry goes elsewhere, so session affinity must not send it back to the failed host
+            lease, r = await hedged_send(payload, None if failed else session_id, tried=failed)
+        except httpx.HTTPError as e:
+            if attempt == OLLAMA_RETRIES or not is_connect_error(e):
+                raise
+            delay = random.uniform(0, min(OLLAMA_RETRY_MAX_DELAY, OLLAMA_RETRY_BASE_DELAY * 2 ** attempt))
+            logger.warning("Ollama connection failed (%s); retry %d/%d in %.2fs", e, attempt + 1, OLLAMA_RETRIES, delay)
+            OLLAMA_RETRIES_TOTAL.inc(model)
+            await asyncio.sleep(delay)
+            continue
+        first_byte.observe(model, payload.get('stream'), time.perf_counter() - t0)
+        return lease, r
+
+def ollama_error(e):
+    """HTTPException for a failed Ollama call: 503 with Retry-After while every breaker is open, else 502."""
+    if isinstance(e, OllamaUnavailable):
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+    return HTTPException(status_code=502, detail=f'error contacting Ollama: {e}')
+
+# ---------------- ollama requests ----------------
+def keep_alive_value(value):
+    # Ollama takes a number of seconds (negative = forever) or a duration string like "30m"
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+def with_keep_alive(body):
+    """`body` with OLLAMA_KEEP_ALIVE added, if one is configured."""
+    if OLLAMA_KEEP_ALIVE:
+        body['keep_alive'] = keep_alive_value(OLLAMA_KEEP_ALIVE)
+    return body
+
+def ollama_request(model, messages, stream=False, **options):
+    """Native /api/chat body with keep_alive.
+
+    Only role and content are sent, in history order, so the prompt of a session's earlier turns is
+    byte-identical from one turn to the next and Ollama can reuse its KV cache for that prefix.
+    """
+    return with_keep_alive({
+        'model': model,
+        'messages': [{'role': m['role'], 'content': m['content']} for m in messages],
+        'stream': stream,
+        'options': {'temperature': 0.2, 'num_predict': 1024, **options},
+    })
+
+class ModelKeeper:
+    """Keeps models loaded on every live Ollama host.
+
+    Every `interval` seconds each model that a host has on disk gets a load-only request (no prompt)
+    with keep_alive, so a model nobody has used for a while is not unloaded and the next user does
+    not pay a cold load.
+    """
+
+    def __init__(self, models=OLLAMA_KEEP_WARM, interval=OLLAMA_KEEPER_INTERVAL):
+        self.models = models
+        self.interval = interval
+        self.pings = 0
+        self.failures = 0
+        self._task: asyncio.Task | None = None
+
+    async def ping(self, host, model):
+        try:
+            r = await get_ollama_client().post(host.base + "/api/generate", json=with_keep_alive({'model': model}))
+            r.raise_for_status()
+            host.loaded.add(model_key(model))
+            self.pings += 1
+        except httpx.HTTPError as e:
+            self.failures += 1
+            logger.warning("Keeping %s warm on %s failed: %s", model, host.base, e)
+
+    async def _run(self):
+        while True:
+            for host in ollama_pool.hosts:
+                if host.ejected:
+                    continue
+                for model in self.models:
+                    # never pull: only models the host already has
+                    if model_key(model) in host.available:
+                        await self.ping(host, model)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.models and self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self):
+        return {"models": self.models, "interval": self.interval, "pings": self.pings, "failures": self.failures}
+
+model_keeper = ModelKeeper()
+
+# ---------------- response cache ----------------
+async def ollama_chat(payload, session_id=None, endpoint="/api/chat"):
+    """One non-streaming chat call through the upstream pool; returns Ollama's JSON."""
+    await provisioner.wait_ready(payload['model'])
+    t0 = time.perf_counter()
+    lease, r = await open_ollama(payload, session_id)
+    error = None
+    try:
+        await r.aread()
+        data = r.json()
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        await r.aclose()
+        ollama_pool.release(lease, error)
+        OLLAMA_SECONDS.observe(time.perf_counter() - t0, endpoint, payload['model'])
+    ollama_timings(data, time.perf_counter() - t0, payload['model'])
+    return data
+
+def response_cache_key(payload):
+    """Key for a chat payload, or None when its reply must not come from the cache.
+
+    Only first turns, or requests at or below RESPONSE_CACHE_MAX_TEMPERATURE, are eligible.
+    """
+    if RESPONSE_CACHE_SIZE <= 0:
+        return None
+    messages = payload['messages']
+    first_turn = sum(1 for m in messages if m['role'] != 'system') == 1
+    if not first_turn and payload.get('options', {}).get('temperature', 1.0) > RESPONSE_CACHE_MAX_TEMPERATURE:
+        return None
+    canon = {k: v for k, v in payload.items() if k not in ('messages', 'stream', 'keep_alive')}
+    canon['model'] = model_key(payload['model'])
+    canon['messages'] = [[m['role'], unicodedata.normalize('NFC', m['content'] or '').strip()] for m in messages]
+    return hashlib.sha256(json.dumps(canon, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+async def cached_ollama_chat(payload, session_id=None, endpoint="/api/chat"):
+    """ollama_chat through the response cache; returns (data, X-Cache value)."""
+    key = response_cache_key(payload)
+    if key is None:
+        return await ollama_chat(payload, session_id, endpoint), "BYPASS"
+    data, status = await response_cache.fetch(key, lambda: ollama_chat(payload, session_id, endpoint))
+    return data, status.upper()
+
+# identical concurrent requests share one generation; size/TTL bounded like the translation cache
+response_cache = TranslationCache(max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+# the same for streams: response cache key -> ChatStream still generating
+response_streams: dict = {}
+
 # ---------------- translator loader ----------------
+def warmup_shapes():
+    """(batch, beam_size) pairs like real traffic: a lone short message greedy and with the full beam,
+    a mid-size batch with the reduced beam, and a full batch of mixed lengths with the full beam."""
+    toks = sorted((encode_text(sp, t) for t in AUTOTUNE_SAMPLES), key=len)
+    full = (toks * (TRANSLATE_MAX_BATCH // len(toks) + 1))[:TRANSLATE_MAX_BATCH]
+    return [(toks[:1], 1), (toks[:1], BEAM), (toks[-8:], max(1, BEAM // 2)), (full, BEAM)]
+
+def warmup_translator(pool):
+    if not TRANSLATOR_WARMUP:
+        return
+    t0 = time.perf_counter()
+    try:
+        shapes = warmup_shapes()
+        for i in range(len(pool.models)):
+            for batch, beam in shapes:
+                pool.translate_batch_sync(batch, replica=i, beam_size=beam,
+                                          max_decoding_length=decoding_length(max(map(len, batch))))
+        logger.info("Warmup: %d batch shape(s) x %d replica(s) in %.1fs",
+                    len(shapes), len(pool.models), time.perf_counter() - t0)
+    except Exception:
+        logger.warning("Warmup failed (non-fatal).")
+
+def build_translator(device=None):
+    """Blocking: load a pool on `device` and warm up every replica."""
+    pool = TranslatorPool(device=device).load()
+    warmup_translator(pool)
+    return pool
+
 def load_translator():
-    global translator, sp
+    global sp
+    profile = load_translator_profile()
+    if profile is None and TRANSLATOR_AUTOTUNE:
+        logger.info("🔧 No translator profile for this host; running autotune...")
+        try:
+            profile = autotune_translator()
+        except Exception as e:
+            logger.warning("Autotune failed (using defaults): %s", e)
+    if profile is not None:
+        apply_translator_profile(profile)
+
     logger.info("🔄 Loading translation model...")
+    sp = load_sp(MODEL_DIR)
     try:
-        translator = ctranslate2.Translator(MODEL_DIR, device="auto")
+        pool = build_translator()
     except Exception as e:
-        logger.warning("Translator init (auto) failed: %s; trying CPU fallback.", e)
+        logger.warning("Translator init (%s) failed: %s; trying %s fallback.",
+                       TRANSLATOR_DEVICE, e, translator_manager.fallback_device)
         try:
-            translator = ctranslate2.Translator(MODEL_DIR, device="cpu")
+            pool = build_translator(translator_manager.fallback_device)
         except Exception as e2:
             logger.exception("Translator init failed entirely: %s", e2)
-            translator = None
             sp = None
+            translator_manager.install(None)
             return
-
-    sp = load_sp(MODEL_DIR)
-    # warmup
-    try:
-        if translator:
-            for _ in range(1):
-                translator.translate_batch([encode_text(sp, "سلام")], beam_size=1)
-    except Exception:
-        logger.warning("Warmup failed (non-fatal).")
+    translator_manager.install(pool)
     logger.info("✅ Translator ready. sentencepiece=%s", bool(sp))
 
-async def preload_ollama_model():
-    try:
-        logger.info(f"🔄 Checking Ollama model: {OLLAMA_MODEL}")
-        # try python ollama client first (may raise if unreachable)
+# ---------------- device manager ----------------
+class TranslatorManager:
+    """Owns the active TranslatorPool and replaces it after a device failure.
+
+    The first caller that reports a failure of the active pool starts a single background reload
+    on the fallback device; every other caller awaits the same future. The new pool replaces the
+    old one in one assignment, so the batcher's next batch already runs on it.
+    """
+
+    def __init__(self, fallback_device=TRANSLATOR_FALLBACK_DEVICE, cooldown=TRANSLATOR_RELOAD_COOLDOWN):
+        self.fallback_device = fallback_device
+        self.cooldown = cooldown
+        self.state = "loading"
+        self.reloads = 0
+        self.last_error = None
+        self.last_reload_at = None
+        self.last_reload_sec = None
+        self._reload: asyncio.Future | None = None
+
+    def install(self, pool):
+        global translator
+        old, translator = translator, pool
+        if pool is None:
+            self.state = "failed"
+        else:
+            self.state = "ready" if pool.device == TRANSLATOR_DEVICE else "degraded"
+        if old is not None and old is not pool:
+            old.close()
+
+    async def recover(self, failed, error):
+        """Return a pool to retry on after `failed` raised `error`, or None if there is none."""
+        if translator is not None and translator is not failed:
+            return translator  # already replaced while this caller was waiting
+        if self.state == "loading":
+            return None  # the initial load is still running; that is not a device failure
+        if self._reload is None:
+            if self.last_reload_at is not None and time.monotonic() - self.last_reload_at < self.cooldown:
+                return None
+            self.last_error = str(error)
+            self._reload = asyncio.get_running_loop().create_future()
+            asyncio.create_task(self._do_reload())
+        return await asyncio.shield(self._reload)
+
+    async def _do_reload(self):
+        fut, device = self._reload, self.fallback_device
+        self.state = "reloading"
+        logger.warning("Translator failure (%s); reloading on %s in the background.", self.last_error, device)
+        t0 = time.perf_counter()
+        pool = None
         try:
-            ollama.show(model=OLLAMA_MODEL)
-            logger.info("Ollama model already present (show successful).")
-        except Exception:
-            logger.info(f"⬇️ Pulling Ollama model via CLI: {OLLAMA_MODEL}")
-            # best-effort CLI pull (may not be present in container environment)
-            os.system(f"ollama pull {OLLAMA_MODEL}")
-    except Exception as e:
-        logger.warning("Ollama preload (best-effort) failed: %s", e)
-    logger.info("✅ Ollama model ready (or pulled/attempted).")
+            pool = await asyncio.to_thread(build_translator, device)
+            self.install(pool)
+            self.reloads += 1
+            logger.info("Translator reloaded on %s in %.1fs.", device, time.perf_counter() - t0)
+        except Exception as e:
+            # keep the old pool: the failure may have been transient, and the cooldown stops a reload storm
+            logger.exception("Translator reload on %s failed: %s", device, e)
+            self.state = "failed"
+        finally:
+            self.last_reload_at = time.monotonic()
+            self.last_reload_sec = round(time.perf_counter() - t0, 3)
+            self._reload = None
+            fut.set_result(pool)
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "device": translator.device if translator is not None else None,
+            "fallback_device": self.fallback_device,
+            "reloads": self.reloads,
+            "last_error": self.last_error,
+            "last_reload_sec": self.last_reload_sec,
+        }
+
+translator_manager = TranslatorManager()
+
+def translator_unavailable():
+    if translator_manager.state == "loading":
+        return HTTPException(status_code=503, detail="Translator is still loading", headers={"Retry-After": "5"})
+    return HTTPException(status_code=503, detail="Translator not available")
+
+# ---------------- model provisioning ----------------
+class ModelProvisioner:
+    """Makes every model in `models` available on every Ollama host, in the background.
+
+    Per host and model: wait for the host to answer, pull through the HTTP API (streamed progress) unless
+    /api/show already knows the model, then load it with keep_alive. All pairs run in parallel.
+    Calls for a model that is still being provisioned wait in wait_ready() instead of failing.
+    """
+
+    ACTIVE = ("checking", "downloading", "loading")
+
+    def __init__(self, models=OLLAMA_PROVISION_MODELS, max_wait=OLLAMA_PROVISION_WAIT):
+        self.models = list(dict.fromkeys(model_key(m) for m in models))
+        self.max_wait = max_wait
+        # downloads and cold loads can go quiet for minutes
+        self.timeout = httpx.Timeout(OLLAMA_CONNECT_TIMEOUT, read=OLLAMA_PULL_READ_TIMEOUT)
+        self.status: dict[tuple, dict] = {}  # (host base, model) -> state and progress
+        self._changed = asyncio.Event()
+
+    def _set(self, host, model, state, **fields):
+        entry = self.status.setdefault((host.base, model), {})
+        changed = entry.get("state") != state
+        entry.update(fields, state=state)
+        if changed:
+            # wake wait_ready(); a fresh event for the next change
+            self._changed.set()
+            self._changed = asyncio.Event()
+
+    def model_state(self, model):
+        """Best state across hosts: ready as soon as one host is."""
+        states = {e["state"] for (_, m), e in self.status.items() if m == model}
+        for s in ("ready", "loading", "downloading", "checking", "unreachable", "failed"):
+            if s in states:
+                return s
+        return "pending"
+
+    def provisioning(self, model):
+        return model in self.models and self.model_state(model) in self.ACTIVE + ("pending",)
+
+    async def wait_ready(self, model):
+        """Queue a call until `model` is ready somewhere (or provisioning stops); 503 after max_wait."""
+        model = model_key(model)
+        if not self.provisioning(model):
+            return
+        t0 = time.perf_counter()
+        deadline = time.monotonic() + self.max_wait
+        while self.provisioning(model):
+            remaining = deadline - time.monotonic()
+            try:
+                await asyncio.wait_for(self._changed.wait(), max(0.0, remaining))
+            except asyncio.TimeoutError:
+                raise OllamaUnavailable(30.0, f"model {model} is still being provisioned") from None
+        trace_add('ollama_provision', time.perf_counter() - t0)
+
+    async def _show(self, host, model):
+        delay = 1.0
+        while True:
+            try:
+                return await get_ollama_client().post(host.base + "/api/show", json={"model": model})
+            except httpx.HTTPError as e:
+                # Ollama may start after us (e.g. docker compose); keep trying in the background
+                if self.status.get((host.base, model), {}).get("state") != "unreachable":
+                    logger.warning("Ollama unreachable at %s (%s); retrying in the background.", host.base, e)
+                self._set(host, model, "unreachable", error=str(e))
+                await asyncio.sleep(delay)
+                delay = min(30.0, delay * 2)
+
+    async def _pull(self, host, model):
+        self._set(host, model, "downloading", completed=0, total=0)
+        logger.info("⬇️ Pulling Ollama model %s on %s", model, host.base)
+        async with get_ollama_client().stream("POST", host.base + "/api/pull", json={"model": model, "stream": True},
+                                              timeout=self.timeout) as r:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                if event.get("error"):
+                    raise RuntimeError(event["error"])
+                entry = self.status[(host.base, model)]
+                entry["detail"] = event.get("status")
+                if event.get("total"):
+                    entry.update(completed=event.get("completed", 0), total=event["total"],
+                                 percent=round(100 * event.get("completed", 0) / event["total"], 1))
+        host.available.add(model)
+
+    async def _load(self, host, model):
+        self._set(host, model, "loading")
+        r = await get_ollama_client().post(host.base + "/api/generate", json=with_keep_alive({"model": model}),
+                                           timeout=self.timeout)
+        r.raise_for_status()
+        host.loaded.add(model)
+
+    async def provision(self, host, model):
+        self._set(host, model, "checking")
+        t0 = time.perf_counter()
+        try:
+            r = await self._show(host, model)
+            self._set(host, model, "checking", error=None)
+            if r.status_code == 200:
+                host.available.add(model)
+            else:
+                await self._pull(host, model)
+            await self._load(host, model)
+        except (httpx.HTTPError, ValueError, RuntimeError) as e:
+            logger.warning("Provisioning %s on %s failed: %s", model, host.base, e)
+            self._set(host, model, "failed", error=str(e))
+            return
+        self._set(host, model, "ready", seconds=round(time.perf_counter() - t0, 1))
+        logger.info("Ollama model %s ready on %s", model, host.base)
+
+    async def run(self):
+        await asyncio.gather(*(self.provision(h, m) for h in ollama_pool.hosts for m in self.models))
+
+    def stats(self):
+        return {m: {"state": self.model_state(m),
+                    "hosts": {base: dict(e) for (base, mm), e in self.status.items() if mm == m}}
+                for m in self.models}
+
+provisioner = ModelProvisioner()
+
+# ---------------- admission control ----------------
+class AdmissionController:
+    """Bounds in-flight chat requests.
+
+    At most `limit` requests run at once and at most `per_session` per session (0 disables that);
+    the rest wait in a FIFO of at most `max_queue` for up to `max_wait` seconds. Anything beyond that
+    is rejected right away with 429 and a Retry-After estimated from recent hold times.
+    """
+
+    def __init__(self, limit=ADMISSION_MAX_CONCURRENCY, per_session=ADMISSION_MAX_PER_SESSION,
+                 max_queue=ADMISSION_MAX_QUEUE, max_wait=ADMISSION_MAX_WAIT_SEC):
+        self.limit = max(1, limit)
+        self.per_session = per_session
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.avg_hold = 1.0  # seconds, moving average
+        self._waiters: deque = deque()
+        self._sessions: dict[str, int] = {}
+        self.admitted = 0
+        self.rejected = {"session": 0, "queue_full": 0, "timeout": 0}
+
+    def retry_after(self):
+        return max(1, math.ceil(self.avg_hold * (len(self._waiters) + 1) / self.limit))
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        ERRORS.inc(request_endpoint.get(), "", "rejected_" + reason)
+        raise HTTPException(status_code=429, detail=f"Server busy ({reason}), try again shortly",
+                            headers={"Retry-After": str(self.retry_after())})
+
+    async def acquire(self, session_id=None):
+        """Wait for a slot and return a ticket for release(); raises HTTPException(429) when saturated."""
+        if session_id and self.per_session > 0 and self._sessions.get(session_id, 0) >= self.per_session:
+            self._reject("session")
+        if session_id:
+            self._sessions[session_id] = self._sessions.get(session_id, 0) + 1
+        try:
+            await self._wait_for_slot()
+        except BaseException:
+            self._leave(session_id)
+            raise
+        self.admitted += 1
+        return session_id, time.monotonic()
+
+    def release(self, ticket):
+        session_id, t0 = ticket
+        self.avg_hold += 0.1 * (time.monotonic() - t0 - self.avg_hold)
+        self._leave(session_id)
+        self._hand_off()
+
+    async def _wait_for_slot(self):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._reject("queue_full")
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        t0 = time.perf_counter()
+        try:
+            await asyncio.wait_for(fut, self.max_wait)
+            trace_add("admission", time.perf_counter() - t0)
+        except asyncio.TimeoutError:
+            if not (fut.done() and not fut.cancelled()):
+                self._reject("timeout")
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._hand_off()  # the slot arrived just as the caller went away
+            raise
+        finally:
+            if fut in self._waiters:
+                self._waiters.remove(fut)
+
+    def _hand_off(self):
+        # the freed slot goes straight to the oldest waiter, so newcomers can't overtake the queue
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    def _leave(self, session_id):
+        if session_id:
+            n = self._sessions.pop(session_id, 0) - 1
+            if n > 0:
+                self._sessions[session_id] = n
+
+    def stats(self):
+        return {"active": self.active, "limit": self.limit, "queued": len(self._waiters), "max_queue": self.max_queue,
+                "sessions": len(self._sessions), "admitted": self.admitted, "rejected": dict(self.rejected),
+                "avg_hold_sec": round(self.avg_hold, 3)}
+
+admission = AdmissionController()
 
 # ---------------- startup ----------------
-@app.on_event("startup")
-async def startup_event():
-    # load translator (blocking) in a thread to avoid blocking event loop
-    await asyncio.to_thread(load_translator)
-    # ask Ollama to pull model (best-effort)
+# per-component startup state for /api/ready; the translator's and Ollama's come from their managers
+readiness = {"segment_store": "pending"}
+startup_tasks: list = []
+
+async def start_translator():
+    await asyncio.to_thread(open_segment_store)
+    readiness["segment_store"] = "ready" if segment_store is not None else "disabled"
     try:
-        await preload_ollama_model()
+        await asyncio.to_thread(load_translator)
     except Exception as e:
-        logger.warning("preload_ollama_model error (ignored): %s", e)
-    logger.info("Startup complete. Translator loaded=%s", translator is not None)
+        logger.exception("Translator load failed: %s", e)
+        translator_manager.install(None)
+
+@app.on_event("startup")
+async def startup_event():
+    # the server accepts requests right away; the model and Ollama come up in the background (see /api/ready)
+    batcher.start()
+    get_ollama_client()
+    ollama_pool.start()
+    model_keeper.start()
+    CONVERSATIONS.start()
+    startup_tasks[:] = [asyncio.create_task(start_translator()), asyncio.create_task(provisioner.run())]
+    logger.info("Startup complete; translator and Ollama model loading in the background.")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in startup_tasks:
+        task.cancel()
+    await batcher.stop()
+    await ollama_pool.stop()
+    await model_keeper.stop()
+    await close_ollama_client()
+    await CONVERSATIONS.stop()
+    if translator is not None:
+        translator.close()
 
 # ---------------- routes ----------------
 @app.get("/", response_class=HTMLResponse)
 async def get_chat(request: Request):
-    # if you have templates/chat.html use TemplateResponse; simple demo returns HTML below
-    return HTMLResponse(CHAT_HTML)
+    # CHAT_HTML below, precompressed at import; browsers revalidate it with If-None-Match (304)
+    return static_response(request, "index.html")
 
 @app.post("/send")
-async def send_message(fa_text: str = Form(...)):
+async def send_message(request: Request, fa_text: str = Form(...)):
     start_time = time.time()
 
     if translator is None:
-        raise HTTPException(status_code=503, detail="Translator not available")
+        raise translator_unavailable()
 
-    toks = encode_text(sp, fa_text)
+    ticket = await admission.acquire()
     try:
-        out = await asyncio.to_thread(translator.translate_batch, [toks], beam_size=5)
-    except RuntimeError as e:
-        logger.exception("RuntimeError in translate_batch (send): %s", e)
-        # try cpu fallback
-        try:
-            tr_local = ctranslate2.Translator(MODEL_DIR, device="cpu")
-            out = await asyncio.to_thread(tr_local.translate_batch, [toks], beam_size=5)
-            globals()['translator'] = tr_local
-        except Exception:
-            logger.exception("Fallback CPU failed in send.")
-            raise HTTPException(status_code=503, detail="Translation failed (CUDA libs missing).")
-    except Exception:
-        logger.exception("Unexpected translation error (send).")
-        raise HTTPException(status_code=500, detail="Internal translation error (send)")
+        decoding = decoding_policy.choose(fa_text)
+        en_text = await translate_text(fa_text, decoding)
 
-    en_text = detokenize_clean(sp, out[0].hypotheses[0])
-
-    try:
-        response = ollama.chat(
-            model=OLLAMA_MODEL,
-            messages=[{"role": "user", "content": en_text}]
-        )
-        ollama_resp = response.get("message", {}).get("content")
-    except Exception as e:
-        logger.exception("Ollama chat (send) failed: %s", e)
-        ollama_resp = str(e)
+        cache_status = "BYPASS"
+        try:
+            data, cache_status = await cached_ollama_chat(
+                ollama_request(OLLAMA_MODEL, [{"role": "user", "content": en_text}]), endpoint="/send")
+            ollama_resp = parse_reply(data)
+        except Exception as e:
+            logger.exception("Ollama chat (send) failed: %s", e)
+            ERRORS.inc("/send", OLLAMA_MODEL, "ollama")
+            ollama_resp = str(e)
+    finally:
+        admission.release(ticket)
 
     duration = time.time() - start_time
-    return JSONResponse({
+    resp = json_with_timings(request, {
         "fa_text": fa_text,
         "en_text": en_text,
         "ollama_response": ollama_resp,
+        "decoding": decoding,
         "duration_sec": duration
     })
+    resp.headers['X-Cache'] = cache_status
+    return resp
+
+# ---------------- conversation store ----------------
+def message_bytes(m):
+    # rough per-message footprint: utf-8 payload plus dict/str overhead
+    return len((m.get('content') or '').encode('utf-8')) + 64
+
+class ConversationStore(ABC):
+    """Session history backend. Messages are dicts with at least role/content/ts."""
+
+    @abstractmethod
+    async def history(self, session_id) -> list[dict]:
+        pass
+
+    @abstractmethod
+    async def append(self, session_id, message):
+        pass
+
+    @abstractmethod
+    async def set_system_prompt(self, session_id, prompt):
+        pass
+
+    @abstractmethod
+    async def clear(self, session_id):
+        pass
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def stats(self):
+        return {}
+
+class MemoryConversationStore(ConversationStore):
+    """In-process store with LRU eviction, per-session caps and idle TTL."""
+
+    def __init__(self, max_sessions=CONV_MAX_SESSIONS, max_messages=CONV_MAX_MESSAGES,
+                 max_bytes=CONV_MAX_BYTES, idle_ttl=CONV_IDLE_TTL, sweep_interval=CONV_SWEEP_INTERVAL):
+        self.max_sessions = max_sessions
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        # session_id -> [messages, bytes, last_access]; ordered from least to most recently used
+        self._sessions: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self._sweeper: asyncio.Task | None = None
+        self.evicted_sessions = 0
+        self.trimmed_messages = 0
+
+    def _touch(self, session_id, create=False):
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            if not create:
+                return None
+            entry = self._sessions[session_id] = [[], 0, 0.0]
+            self._evict_lru()
+        entry[2] = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        return entry
+
+    def _evict_lru(self):
+        while self.max_sessions > 0 and len(self._sessions) > self.max_sessions:
+            _, (_, nbytes, _) = self._sessions.popitem(last=False)
+            self._bytes -= nbytes
+            self.evicted_sessions += 1
+
+    def _trim(self, entry):
+        msgs = entry[0]
+        def over():
+            return ((self.max_messages > 0 and len(msgs) > self.max_messages)
+                    or (self.max_bytes > 0 and entry[1] > self.max_bytes))
+        # drop the oldest turns first, but never the system prompt or the newest message
+        i = 0
+        while over() and i < len(msgs) - 1:
+            if msgs[i].get('role') == 'system':
+                i += 1
+                continue
+            nbytes = message_bytes(msgs.pop(i))
+            entry[1] -= nbytes
+            self._bytes -= nbytes
+            self.trimmed_messages += 1
+
+    async def history(self, session_id):
+        entry = self._touch(session_id)
+        return list(entry[0]) if entry else []
+
+    async def append(self, session_id, message):
+        entry = self._touch(session_id, create=True)
+        nbytes = message_bytes(message)
+        entry[0].append(message)
+        entry[1] += nbytes
+        self._bytes += nbytes
+        self._trim(entry)
+
+    async def set_system_prompt(self, session_id, prompt):
+        entry = self._touch(session_id, create=True)
+        for m in [m for m in entry[0] if m.get('role') == 'system']:
+            entry[0].remove(m)
+            entry[1] -= message_bytes(m)
+            self._bytes -= message_bytes(m)
+        m = {'role':'system','content':prompt,'ts':time.time()}
+        entry[0].insert(0, m)
+        entry[1] += message_bytes(m)
+        self._bytes += message_bytes(m)
+        self._trim(entry)
+
+    async def clear(self, session_id):
+        entry = self._sessions.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def sweep(self):
+        if self.idle_ttl <= 0:
+            return 0
+        cutoff = time.monotonic() - self.idle_ttl
+        removed = 0
+        # LRU order: stop at the first session that is still fresh
+        while self._sessions:
+            session_id, entry = next(iter(self._sessions.items()))
+            if entry[2] >= cutoff:
+                break
+            self._sessions.pop(session_id)
+            self._bytes -= entry[1]
+            removed += 1
+        self.evicted_sessions += removed
+        return removed
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            removed = self.sweep()
+            if removed:
+                logger.info("Conversation sweeper evicted %d idle sessions.", removed)
+
+    def start(self):
+        if self.sweep_interval > 0 and (self._sweeper is None or self._sweeper.done()):
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        task, self._sweeper = self._sweeper, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "sessions": len(self._sessions),
+            "messages": sum(len(e[0]) for e in self._sessions.values()),
+            "bytes": self._bytes,
+            "evicted_sessions": self.evicted_sessions,
+            "trimmed_messages": self.trimmed_messages,
+        }
+
+class SqliteConversationStore(ConversationStore):
+    """SQLite (WAL) store shared by several worker processes on one host.
+
+    Writes are queued and committed by a background flusher in one transaction per interval,
+    so requests never wait on disk. Reads merge the rows on disk with this worker's queued
+    writes; every op is idempotent (messages carry a msg_id), so replaying an op that has
+    already been committed is harmless.
+    """
+
+    def __init__(self, path=SESSION_DB_PATH, flush_interval_ms=SESSION_FLUSH_INTERVAL_MS,
+                 max_sessions=CONV_MAX_SESSIONS, max_messages=CONV_MAX_MESSAGES,
+                 max_bytes=CONV_MAX_BYTES, idle_ttl=CONV_IDLE_TTL, sweep_interval=CONV_SWEEP_INTERVAL):
+        self.path = path
+        self.flush_interval = max(0.001, flush_interval_ms / 1000.0)
+        self.max_sessions = max_sessions
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._pending: list[tuple] = []
+        self._flushing: list[tuple] = []
+        self._wakeup: asyncio.Event | None = None
+        self._tasks: list[asyncio.Task] = []
+        self.flushes = 0
+        self.flushed_ops = 0
+        self.flush_failures = 0  # consecutive
+        self.evicted_sessions = 0
+        self._gauges = {"sessions": 0, "messages": 0, "bytes": 0}
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "session_id TEXT NOT NULL, msg_id TEXT NOT NULL UNIQUE, role TEXT NOT NULL, "
+                         "content TEXT NOT NULL, ts REAL, extra TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id)")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, last_access REAL NOT NULL)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # -- ops: ('append', sid, msg) | ('system', sid, msg) | ('clear', sid, None) | ('touch', sid, None)
+    def _queue(self, op, session_id, message=None):
+        self._pending.append((op, session_id, message, time.time()))
+        if self._wakeup is not None and not self._wakeup.is_set():
+            self._wakeup.set()
+
+    @staticmethod
+    def _apply(msgs, op, message):
+        if op == 'append':
+            if all(m.get('msg_id') != message['msg_id'] for m in msgs):
+                msgs.append(message)
+        elif op == 'system':
+            msgs[:] = [m for m in msgs if m.get('role') != 'system']
+            msgs.insert(0, message)
+        elif op == 'clear':
+            msgs.clear()
+        return msgs
+
+    def _trim(self, msgs):
+        nbytes = sum(message_bytes(m) for m in msgs)
+        i = 0
+        while i < len(msgs) - 1 and ((self.max_messages > 0 and len(msgs) > self.max_messages)
+                                     or (self.max_bytes > 0 and nbytes > self.max_bytes)):
+            if msgs[i].get('role') == 'system':
+                i += 1
+                continue
+            nbytes -= message_bytes(msgs.pop(i))
+        return msgs
+
+    def _read(self, session_id):
+        rows = self._conn().execute(
+            # a replaced system prompt gets a new id; keep it first, as _apply does for queued ops
+            "SELECT msg_id, role, content, ts, extra FROM messages WHERE session_id = ? "
+            "ORDER BY role != 'system', id",
+            (session_id,)).fetchall()
+        msgs = []
+        for msg_id, role, content, ts, extra in rows:
+            m = json.loads(extra) if extra else {}
+            m.update({'role': role, 'content': content, 'ts': ts, 'msg_id': msg_id})
+            msgs.append(m)
+        return msgs
+
+    async def history(self, session_id):
+        ops = [o for o in self._flushing + self._pending if o[1] == session_id]
+        msgs = await asyncio.to_thread(self._read, session_id)
+        for op, _, message, _ in ops:
+            self._apply(msgs, op, message)
+        self._queue('touch', session_id)
+        return self._trim(msgs)
+
+    async def append(self, session_id, message):
+        message = dict(message)
+        message.setdefault('msg_id', uuid.uuid4().hex)
+        self._queue('append', session_id, message)
+
+    async def set_system_prompt(self, session_id, prompt):
+        self._queue('system', session_id, {'role':'system','content':prompt,'ts':time.time(),
+                                           'msg_id': uuid.uuid4().hex})
+
+    async def clear(self, session_id):
+        self._queue('clear', session_id)
+
+    def _write(self, ops):
+        touched = set()
+        with self._conn() as conn:
+            for op, sid, message, ts in ops:
+                if op == 'touch':
+                    conn.execute("UPDATE sessions SET last_access = max(last_access, ?) WHERE session_id = ?", (ts, sid))
+                    continue
+                conn.execute("INSERT INTO sessions (session_id, last_access) VALUES (?, ?) "
+                             "ON CONFLICT(session_id) DO UPDATE SET last_access = max(last_access, excluded.last_access)",
+                             (sid, ts))
+                if op in ('append', 'system'):
+                    if op == 'system':
+                        conn.execute("DELETE FROM messages WHERE session_id = ? AND role = 'system'", (sid,))
+                    extra = {k: v for k, v in message.items() if k not in ('role', 'content', 'ts', 'msg_id')}
+                    conn.execute("INSERT OR IGNORE INTO messages (session_id, msg_id, role, content, ts, extra) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)",
+                                 (sid, message['msg_id'], message['role'], message['content'], message.get('ts'),
+                                  json.dumps(extra, ensure_ascii=False) if extra else None))
+                    touched.add(sid)
+                elif op == 'clear':
+                    conn.execute("DELETE FROM messages WHERE session_id = ?", (sid,))
+                    conn.execute("DELETE FROM sessions WHERE session_id = ?", (sid,))
+            for sid in touched:
+                rows = conn.execute("SELECT id, role, length(CAST(content AS BLOB)) + 64 FROM messages "
+                                    "WHERE session_id = ? ORDER BY role != 'system', id", (sid,)).fetchall()
+                drop = self._rows_over_limit(rows)
+                if drop:
+                    conn.executemany("DELETE FROM messages WHERE id = ?", [(i,) for i in drop])
+
+    def _rows_over_limit(self, rows):
+        count, nbytes = len(rows), sum(r[2] for r in rows)
+        drop = []
+        for row_id, role, size in rows[:-1]:
+            if not ((self.max_messages > 0 and count > self.max_messages)
+                    or (self.max_bytes > 0 and nbytes > self.max_bytes)):
+                break
+            if role == 'system':
+                continue
+            drop.append(row_id)
+            count -= 1
+            nbytes -= size
+        return drop
+
+    async def flush(self):
+        """Commit queued ops; returns False if they failed and were re-queued."""
+        if not self._pending:
+            return True
+        self._flushing, self._pending = self._pending, []
+        try:
+            await asyncio.to_thread(self._write, self._flushing)
+            self.flushes += 1
+            self.flushed_ops += len(self._flushing)
+            self.flush_failures = 0
+            return True
+        except Exception as e:
+            logger.warning("Session flush failed (%d ops re-queued): %s", len(self._flushing), e)
+            self._pending[:0] = self._flushing
+            self.flush_failures += 1
+            return False
+        finally:
+            self._flushing = []
+
+    async def _flush_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # let writes from concurrent requests accumulate into one transaction
+            await asyncio.sleep(self.flush_interval)
+            if not await self.flush():
+                # retry the re-queued ops with backoff, even if no new write comes in
+                await asyncio.sleep(min(30.0, self.flush_interval * 2 ** self.flush_failures))
+                self._wakeup.set()
+
+    def sweep(self):
+        with self._conn() as conn:
+            stale = []
+            if self.idle_ttl > 0:
+                stale += [r[0] for r in conn.execute("SELECT session_id FROM sessions WHERE last_access < ?",
+                                                     (time.time() - self.idle_ttl,))]
+            if self.max_sessions > 0:
+                stale += [r[0] for r in conn.execute(
+                    "SELECT session_id FROM sessions ORDER BY last_access DESC LIMIT -1 OFFSET ?",
+                    (self.max_sessions,))]
+            stale = list(dict.fromkeys(stale))
+            for sid in stale:
+                conn.execute("DELETE FROM messages WHERE session_id = ?", (sid,))
+                conn.execute("DELETE FROM sessions WHERE session_id = ?", (sid,))
+            sessions = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            messages, nbytes = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(length(CAST(content AS BLOB)) + 64), 0) FROM messages").fetchone()
+        self._gauges = {"sessions": sessions, "messages": messages, "bytes": nbytes}
+        self.evicted_sessions += len(stale)
+        return len(stale)
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                removed = await asyncio.to_thread(self.sweep)
+                if removed:
+                    logger.info("Conversation sweeper evicted %d sessions.", removed)
+            except Exception as e:
+                logger.warning("Session sweep failed: %s", e)
+            await asyncio.sleep(self.sweep_interval if self.sweep_interval > 0 else 60)
+
+    def start(self):
+        if self._tasks and not all(t.done() for t in self._tasks):
+            return
+        self._wakeup = asyncio.Event()
+        if self._pending:
+            self._wakeup.set()
+        self._tasks = [asyncio.create_task(self._flush_loop()), asyncio.create_task(self._sweep_loop())]
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    def stats(self):
+        return {
+            "backend": "sqlite",
+            **self._gauges,
+            "pending_writes": len(self._pending) + len(self._flushing),
+            "flush_failures": self.flush_failures,
+            "flushes": self.flushes,
+            "flushed_ops": self.flushed_ops,
+            "evicted_sessions": self.evicted_sessions,
+        }
+
+def create_conversation_store():
+    if SESSION_BACKEND == "sqlite":
+        try:
+            return SqliteConversationStore()
+        except Exception as e:
+            logger.warning("SQLite session store unavailable (%s); using in-memory sessions.", e)
+    elif SESSION_BACKEND != "memory":
+        logger.warning("Unknown SESSION_BACKEND=%r; using in-memory sessions.", SESSION_BACKEND)
+    return MemoryConversationStore()
+
+CONVERSATIONS: ConversationStore = create_conversation_store()
+
+# ---------------- context window ----------------
+def count_tokens(text):
+    if not text:
+        return 0
+    if CONTEXT_TOKENIZER == "sentencepiece" and sp is not None:
+        return len(sp.encode(text))
+    return int(len(text) / CONTEXT_CHARS_PER_TOKEN) + 1
+
+def context_budget(model):
+    return int(CONTEXT_TOKEN_BUDGETS.get(model, CONTEXT_TOKEN_BUDGET))
+
+def _truncate_to_tokens(text, tokens):
+    # binary search on a character prefix so this works with any counter
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid] + " …") <= tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo].rstrip() + " …"
+
+def build_context(messages, budget, counter=None, anchor=None, refill=CONTEXT_REFILL_RATIO):
+    """Fit a chat history into a token budget.
+
+    System messages and the newest message are always kept. If the window starting at `anchor`
+    (the ts of the first message kept last time) still fits, it is used unchanged, so the prompt
+    prefix stays the same and Ollama can reuse its KV cache. Otherwise older turns are added newest
+    first up to `refill` of the budget, and the turn that straddles that limit is truncated if enough
+    room is left; the slack lets the next turns extend this window instead of sliding it every turn.
+    Only the kept window is counted, so cost does not grow with session length.
+    """
+    counter = counter or count_tokens
+    cost = lambda m: counter(m.get('content')) + CONTEXT_MESSAGE_OVERHEAD
+    system = [m for m in messages if m.get('role') == 'system']
+    rest = [m for m in messages if m.get('role') != 'system']
+    if not rest:
+        return list(system), {"tokens": sum(cost(m) for m in system), "budget": budget, "dropped": 0,
+                              "truncated": False, "anchor": None}
+
+    system_cost = sum(cost(m) for m in system)
+    start = next((i for i, m in enumerate(rest) if anchor is not None and m.get('ts') == anchor), 0)
+    used = system_cost + sum(cost(m) for m in rest[start:])
+    if used <= budget:
+        return system + rest[start:], {"tokens": used, "budget": budget, "dropped": start, "truncated": False,
+                                       "anchor": rest[start].get('ts')}
+
+    limit = int(budget * refill)
+    used = system_cost + cost(rest[-1])
+    kept, truncated = [rest[-1]], False
+    for m in reversed(rest[:-1]):
+        c = cost(m)
+        if used + c <= limit:
+            kept.append(m)
+            used += c
+            continue
+        room = limit - used - CONTEXT_MESSAGE_OVERHEAD
+        if room >= CONTEXT_MIN_TRIM_TOKENS:
+            m = dict(m, content=_truncate_to_tokens(m.get('content') or '', room))
+            kept.append(m)
+            used += cost(m)
+            truncated = True
+        break
+    kept.reverse()
+    # a truncated turn can't be reproduced next time, so the window is anchored after it
+    first = kept[1] if truncated and len(kept) > 1 else kept[0]
+    return system + kept, {"tokens": used, "budget": budget, "dropped": len(rest) - len(kept),
+                           "truncated": truncated, "anchor": first.get('ts')}
+
+context_anchors: OrderedDict = OrderedDict()  # session -> ts of the first message in its last window
+
+def remember_context_anchor(session_id, anchor):
+    context_anchors[session_id] = anchor
+    context_anchors.move_to_end(session_id)
+    while len(context_anchors) > CONV_MAX_SESSIONS:
+        context_anchors.popitem(last=False)
 
 # ---------------- chat API (with translation option) ----------------
-CONVERSATIONS: dict[str, list[dict]] = {}
 
 class ChatReq(BaseModel):
     message: str
@@ -177,9 +2607,19 @@ class ChatReq(BaseModel):
     system_prompt: str | None = None
     use_translation: bool | None = False
 
-@app.post("/api/chat")
-async def chat_endpoint(req: Request):
-    body = await req.json()
+def source_hash(text):
+    return hashlib.sha256(normalize_source(text).encode('utf-8')).hexdigest()[:16]
+
+def cached_translation(m):
+    """The stored English form of a user turn, if it was produced by the current model for this text."""
+    en = m.get('en')
+    if not en or m.get('role') != 'user' or m.get('mt_model') != MODEL_DIR:
+        return None
+    if m.get('src_hash') != source_hash(m.get('content') or ''):
+        return None
+    return en
+
+async def prepare_chat(body):
     message = body.get('message')
     session_id = body.get('session_id') or str(uuid.uuid4())
     model = body.get('model') or OLLAMA_MODEL
@@ -189,71 +2629,48 @@ async def chat_endpoint(req: Request):
     if not message:
         raise HTTPException(status_code=400, detail='message is required')
 
-    conv = CONVERSATIONS.setdefault(session_id, [])
-    if system_prompt:
-        conv = [m for m in conv if m.get('role')!='system']
-        conv.insert(0, {'role':'system','content':system_prompt,'ts':time.time()})
-        CONVERSATIONS[session_id] = conv
-
-    conv.append({'role':'user','content':message,'ts':time.time()})
-
-    translated_en = None
+    user_msg = {'role':'user','content':message,'ts':time.time()}
+    translated_en = decoding = None
     if use_translation:
         if translator is None:
-            raise HTTPException(status_code=503, detail='Translator not available on server')
-        tokens = encode_text(sp, message)
-        try:
-            # IMPORTANT: pass beam_size as keyword so it doesn't become target_prefix
-            res = await asyncio.to_thread(translator.translate_batch, [tokens], beam_size=BEAM)
-        except RuntimeError as e:
-            logger.exception("RuntimeError in translate_batch: %s", e)
-            # fallback: try recreate translator with CPU and retry
-            try:
-                tr_local = ctranslate2.Translator(MODEL_DIR, device="cpu")
-                res = await asyncio.to_thread(tr_local.translate_batch, [tokens], beam_size=BEAM)
-                globals()['translator'] = tr_local
-            except Exception:
-                logger.exception("Fallback to CPU failed in chat_endpoint.")
-                raise HTTPException(status_code=503, detail="Translation failed (CUDA libs missing).")
-        except Exception:
-            logger.exception("Unexpected translation error in chat_endpoint.")
-            raise HTTPException(status_code=500, detail="Internal translation error")
-
-        out_pieces = res[0].hypotheses[0]
-        translated_en = detokenize_clean(sp, out_pieces)
-
-    # Build payload for Ollama; replace last user message with translated EN if present
+            raise translator_unavailable()
+        decoding = decoding_policy.choose(message)
+        translated_en = await translate_text(message, decoding)
+        # memo: later turns reuse this instead of re-translating the history
+        user_msg.update({'en': translated_en, 'src_hash': source_hash(message), 'mt_model': MODEL_DIR,
+                         'mt_beam': decoding['beam_size']})
+
+    await CONVERSATIONS.append(session_id, user_msg)
+    conv = await CONVERSATIONS.history(session_id)
+    # re-storing an unchanged system prompt every turn would churn the store; only store real changes
+    current = next((m.get('content') for m in conv if m.get('role') == 'system'), None)
+    if system_prompt and system_prompt != current:
+        await CONVERSATIONS.set_system_prompt(session_id, system_prompt)
+        conv = [{'role': 'system', 'content': system_prompt, 'ts': time.time()}] + \
+               [m for m in conv if m.get('role') != 'system']
+
+    # Build payload for Ollama; user turns that were translated are sent in English
     messages_payload = []
     for m in conv:
         role = m.get('role')
-        content = m.get('content')
-        if role == 'user' and content == message and translated_en:
-            messages_payload.append({'role':'user','content': translated_en})
-        else:
-            messages_payload.append({'role': role if role in ('user','assistant','system') else 'user', 'content': content})
-
-    payload = {
-        'model': model,
-        'messages': messages_payload,
-        'temperature': 0.2,
-        'max_tokens': 1024,
-    }
+        content = cached_translation(m) or m.get('content')
+        messages_payload.append({'role': role if role in ('user','assistant','system') else 'user', 'content': content,
+                                 'ts': m.get('ts')})
 
-    headers = {'Content-Type':'application/json'}
-    url = OLLAMA_BASE.rstrip('/') + OLLAMA_CHAT_PATH
+    messages_payload, context = build_context(messages_payload, context_budget(model),
+                                              anchor=context_anchors.get(session_id))
+    remember_context_anchor(session_id, context.pop('anchor'))
 
-    try:
-        async with httpx.AsyncClient(timeout=120) as client:
-            r = await client.post(url, json=payload, headers=headers)
-            r.raise_for_status()
-            data = r.json()
-    except Exception as e:
-        logger.exception("Error contacting Ollama: %s", e)
-        raise HTTPException(status_code=502, detail=f'error contacting Ollama: {e}')
+    payload = ollama_request(model, messages_payload)
+    return {'session_id': session_id, 'translated': translated_en, 'payload': payload,
+            'context': context, 'decoding': decoding}
 
-    # parse reply
+def parse_reply(data):
     reply = None
     try:
+        msg = data.get('message')  # native /api/chat
+        if isinstance(msg, dict) and isinstance(msg.get('content'), str) and msg['content']:
+            return msg['content']
         choices = data.get('choices')
         if choices and isinstance(choices, list):
             parts = []
@@ -274,23 +2691,304 @@ async def chat_endpoint(req: Request):
 
     if not reply:
         reply = str(data)
+    return reply
+
+def parse_stream_line(line):
+    """Returns (delta_text, done, data) for one line of an OpenAI SSE or Ollama NDJSON stream."""
+    line = line.strip()
+    if line.startswith('data:'):
+        line = line[5:].strip()
+    if not line or line.startswith(':'):
+        return '', False, None
+    if line == '[DONE]':
+        return '', True, None
+    try:
+        data = json.loads(line)
+    except ValueError:
+        return '', False, None
+    delta = ''
+    for c in data.get('choices') or []:
+        msg = c.get('delta') or c.get('message') or {}
+        if isinstance(msg, dict) and msg.get('content'):
+            delta += msg['content']
+    if not delta:
+        msg = data.get('message')
+        if isinstance(msg, dict) and isinstance(msg.get('content'), str):
+            delta = msg['content']
+        elif isinstance(data.get('response'), str):
+            delta = data['response']
+    return delta, bool(data.get('done')), data
+
+def sse_event(data, event=None):
+    head = f'event: {event}\n' if event else ''
+    return f'{head}data: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+class ChatStream:
+    """One upstream Ollama stream, relayed to every identical request that arrives while it runs.
+
+    The first request registers it under its response cache key and opens it; later ones replay the
+    deltas so far, then follow the live ones. The upstream is read by its own task, so the first client
+    going away doesn't cut the others off; it is only closed early once every request has left(). A
+    complete reply goes to the response cache.
+    """
+
+    def __init__(self, payload, cache_key=None):
+        self.payload = payload
+        self.cache_key = cache_key
+        self.parts: list[str] = []
+        self.done = False
+        self.error: Exception | None = None
+        self.clients = 1  # the request that creates it
+        self._changed = asyncio.Event()
+        self._opening: asyncio.Future | None = None
+        self._task: asyncio.Task | None = None
+        if cache_key:
+            response_streams[cache_key] = self
+
+    def open(self, session_id):
+        # not tied to the first request: its client leaving must not fail the open for the others
+        self._opening = asyncio.ensure_future(self._open(session_id))
+
+    async def opened(self):
+        """Wait for the upstream to answer; a connection error is raised to every request."""
+        await asyncio.shield(self._opening)
+
+    async def _open(self, session_id):
+        try:
+            await provisioner.wait_ready(self.payload['model'])
+            t0 = time.perf_counter()
+            lease, r = await open_ollama(self.payload, session_id)
+        except BaseException:
+            self.done = True
+            self._unregister()
+            raise
+        self._task = asyncio.create_task(self._read(lease, r, t0))
+
+    async def _read(self, lease, r, t0):
+        model = self.payload['model']
+        complete, final = False, None
+        try:
+            async for line in r.aiter_lines():
+                delta, done, data = parse_stream_line(line)
+                if delta:
+                    if not self.parts:
+                        OLLAMA_FIRST_TOKEN.observe(time.perf_counter() - t0, model)
+                    self.parts.append(delta)
+                    self._notify()
+                if done:
+                    complete, final = True, data
+                    break
+            # the native stream's last line carries the durations
+            ollama_timings(final or {}, time.perf_counter() - t0, model)
+            if complete and self.cache_key:
+                response_cache.put(self.cache_key, {'message': {'role': 'assistant', 'content': ''.join(self.parts)}})
+        except Exception as e:
+            self.error = e
+            logger.exception("Ollama stream interrupted: %s", e)
+            ERRORS.inc("/api/chat/stream", model, "ollama_stream")
+        finally:
+            await r.aclose()
+            ollama_pool.release(lease, self.error)
+            OLLAMA_SECONDS.observe(time.perf_counter() - t0, "/api/chat/stream", model)
+            self.done = True
+            self._unregister()
+            self._notify()
+
+    def _notify(self):
+        # wake every follow(); a fresh event for the next change
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _unregister(self):
+        if self.cache_key and response_streams.get(self.cache_key) is self:
+            del response_streams[self.cache_key]
+
+    def join(self):
+        self.clients += 1
+        return self
+
+    def leave(self):
+        self.clients -= 1
+        if not self.clients and not self.done:
+            # nobody is listening any more: stop generating
+            (self._task or self._opening).cancel()
+
+    async def follow(self):
+        """Deltas from the start of the reply until the upstream ends; check `error` afterwards."""
+        i = 0
+        while True:
+            changed = self._changed
+            while i < len(self.parts):
+                yield self.parts[i]
+                i += 1
+            if self.done:
+                return
+            await changed.wait()
+
+@app.post("/api/chat")
+async def chat_endpoint(req: Request):
+    body = await req.json()
+    ticket = await admission.acquire(body.get('session_id'))
+    try:
+        chat = await prepare_chat(body)
+        session_id, payload = chat['session_id'], chat['payload']
+
+        try:
+            data, cache_status = await cached_ollama_chat(payload, session_id)
+        except Exception as e:
+            logger.exception("Error contacting Ollama: %s", e)
+            ERRORS.inc("/api/chat", payload['model'], "ollama")
+            raise ollama_error(e)
+
+        reply = parse_reply(data)
+
+        await CONVERSATIONS.append(session_id, {'role':'assistant','content':reply,'ts':time.time()})
+    finally:
+        admission.release(ticket)
+
+    resp = json_with_timings(req, {'reply': reply, 'session_id': session_id, 'translated': chat['translated'] or '',
+                                   'context': chat['context'], 'decoding': chat['decoding']})
+    resp.headers['X-Cache'] = cache_status
+    return resp
+
+@app.post("/api/chat/stream")
+async def chat_stream_endpoint(req: Request):
+    body = await req.json()
+    # the slot is held until the relay below finishes, not just until the handler returns
+    ticket = await admission.acquire(body.get('session_id'))
+    try:
+        chat = await prepare_chat(body)
+        session_id, payload = chat['session_id'], chat['payload']
+        payload['stream'] = True
+
+        # a cached reply is replayed as a single delta; an identical stream still generating is joined
+        # from its first delta; a complete streamed reply is cached for later requests
+        cache_key = response_cache_key(payload)
+        cached = response_cache.get(cache_key) if cache_key else None
+        stream = response_streams.get(cache_key) if cache_key and cached is None else None
+        if cached is not None:
+            cache_status, response_cache.hits = "HIT", response_cache.hits + 1
+        elif stream is not None:
+            cache_status, response_cache.coalesced = "COALESCED", response_cache.coalesced + 1
+            stream.join()
+        else:
+            cache_status = "MISS" if cache_key else "BYPASS"
+            response_cache.misses += bool(cache_key)
+            stream = ChatStream(payload, cache_key)
+            stream.open(session_id)
 
-    conv.append({'role':'assistant','content':reply,'ts':time.time()})
-    CONVERSATIONS[session_id] = conv
+        if stream is not None:
+            # wait for the upstream before answering so connection errors still become a 502/503
+            try:
+                await stream.opened()
+            except BaseException as e:
+                stream.leave()
+                if not isinstance(e, Exception):
+                    raise
+                logger.exception("Error contacting Ollama (stream): %s", e)
+                ERRORS.inc("/api/chat/stream", payload['model'], "ollama")
+                raise ollama_error(e)
+    except BaseException:
+        admission.release(ticket)
+        raise
+
+    async def relay():
+        parts = []
+        try:
+            yield sse_event({'session_id': session_id, 'translated': chat['translated'] or '',
+                             'context': chat['context'], 'decoding': chat['decoding']}, 'meta')
+            if cached is not None:
+                parts.append(parse_reply(cached))
+                yield sse_event({'delta': parts[0]})
+            else:
+                async for delta in stream.follow():
+                    parts.append(delta)
+                    yield sse_event({'delta': delta})
+            if stream is not None and stream.error is not None:
+                yield sse_event({'detail': f'error contacting Ollama: {stream.error}'}, 'error')
+            else:
+                done_event = {'reply': ''.join(parts)}
+                if wants_timings(req):
+                    done_event['timings'] = trace_snapshot()
+                yield sse_event(done_event, 'done')
+        finally:
+            if stream is not None:
+                stream.leave()
+            admission.release(ticket)
+            # keep whatever was generated, even if the browser went away mid-stream
+            if parts:
+                await CONVERSATIONS.append(session_id, {'role':'assistant','content':''.join(parts),'ts':time.time()})
 
-    return JSONResponse({'reply': reply, 'session_id': session_id, 'translated': translated_en or ''})
+    return StreamingResponse(relay(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', 'X-Cache': cache_status})
 
 @app.post('/api/clear')
 async def clear_conv(req: Request):
     body = await req.json()
     session_id = body.get('session_id')
-    if session_id and session_id in CONVERSATIONS:
-        CONVERSATIONS.pop(session_id, None)
+    if session_id:
+        await CONVERSATIONS.clear(session_id)
     return JSONResponse({'ok': True})
 
 @app.get("/api/health")
 async def health_check():
-    return {"status": "ok", "translator": translator is not None}
+    return {"status": "ok", "translator": translator is not None,
+            "translator_pool": translator.stats() if translator is not None else None,
+            "translator_manager": translator_manager.stats(), "batcher": batcher.stats(),
+            "decoding_policy": decoding_policy.stats(), "admission": admission.stats(),
+            "ollama_pool": ollama_pool.stats(), "ollama_hedge": {"enabled": OLLAMA_HEDGE, "models": first_byte.stats()},
+            "model_keeper": model_keeper.stats(),
+            "translation_cache": translation_cache.stats(), "response_cache": response_cache.stats(),
+            "conversations": CONVERSATIONS.stats()}
+
+@app.get("/metrics")
+async def metrics():
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/ready")
+async def ready_check():
+    """Per-component startup state; 200 once the translator and the Ollama model can serve, else 503."""
+    model = model_key(OLLAMA_MODEL)
+    components = {"translator": translator_manager.state, **readiness, "ollama": provisioner.model_state(model),
+                  "ollama_hosts": {h.base: provisioner.status.get((h.base, model), {}).get("state", "pending")
+                                   for h in ollama_pool.hosts}}
+    ready = translator_manager.state in ("ready", "degraded") and components["ollama"] == "ready"
+    return JSONResponse({"ready": ready, "components": components}, status_code=200 if ready else 503)
+
+@app.get("/api/models")
+async def models_status():
+    """Download and load progress of every provisioned model, per host."""
+    return JSONResponse({"models": provisioner.stats()})
+# ---------------- static UI ----------------
+# vendored JS/CSS/fonts, hashed and precompressed by `python static_bundle.py` (run in the Dockerfile);
+# without that build the page falls back to the CDN copies
+static_bundle = StaticBundle.load()
+if not static_bundle.urls:
+    logger.info("Static bundle not built (STATIC_DIST_DIR=%s); the UI loads its assets from the CDN.", STATIC_DIST_DIR)
+
+def asset_url(name):
+    return static_bundle.url(name) or VENDOR[name]
+
+def font_tags():
+    fonts = {w: static_bundle.url(f"jetbrains-mono-latin-{w}-normal.woff2") for w in FONT_WEIGHTS}
+    if not all(fonts.values()):
+        return ('<link href="https://fonts.googleapis.com/css2?family=JetBrains+Mono:wght@300;400;600;700&display=swap"'
+                ' rel="stylesheet">')
+    faces = "".join(f"@font-face{{font-family:'JetBrains Mono';font-style:normal;font-weight:{w};font-display:swap;"
+                    f"src:url({url}) format('woff2')}}" for w, url in fonts.items())
+    return f"<style>{faces}</style>"
+
+def static_response(request, name):
+    found = static_bundle.lookup(name, request.headers.get("if-none-match"), request.headers.get("accept-encoding"))
+    if found is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    status, body, headers = found
+    return Response(body, status_code=status, headers=headers)
+
+@app.get("/static/{name}")
+async def static_file(name: str, request: Request):
+    return static_response(request, name)
+
 # ---------------- UI HTML (Markdown + code highlighting, with RTL & copy) ----------------
 CHAT_HTML = r"""<!doctype html>
 <html lang="fa">
@@ -300,9 +2998,9 @@ CHAT_HTML = r"""<!doctype html>
   <title>چت با qwen2.5-coder + ترجمه (Fa→En)</title>
 
   <!-- JetBrains Mono -->
-  <link href="https://fonts.googleapis.com/css2?family=JetBrains+Mono:wght@300;400;600;700&display=swap" rel="stylesheet">
+  """ + font_tags() + """
   <!-- highlight.js CSS -->
-  <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/styles/github.min.css">
+  """ + f'<link rel="stylesheet" href="{asset_url("github.min.css")}">' + """
 
   <style>
     :root{
@@ -415,7 +3113,7 @@ CHAT_HTML = r"""<!doctype html>
       <div>
         <h1>چت با qwen2.5-coder</h1>
         <div class="meta">
-          سرور Ollama: <code>""" + OLLAMA_BASE + """</code> · ترجمه محلی: <code>quickmt-fa-en</code><br>
+          سرور Ollama: <code>""" + ", ".join(OLLAMA_HOSTS) + """</code> · ترجمه محلی: <code>quickmt-fa-en</code><br>
           GitHub: <a href="https://github.com/sepehr.ramzany" style="color:#4f46e5" target="_blank">sepehr.ramzany</a> ·
           Twitter/X: <a href="https://twitter.com/sepy_dev" style="color:#4f46e5" target="_blank">@sepy_dev</a>
         </div>
@@ -425,9 +3123,7 @@ CHAT_HTML = r"""<!doctype html>
     <div class="controls">
       <label class="small">مدل
         <select id="model" class="select small">
-          <option value="qwen2.5-coder:1.5b">qwen2.5-coder:1.5b</option>
-          <option value="qwen2.5-coder:0.5b">qwen2.5-coder:0.5b</option>
-          <option value="qwen2.5-coder:3b">qwen2.5-coder:3b</option>
+          """ + "\n          ".join(f'<option value="{m}">{m}</option>' for m in OLLAMA_UI_MODELS) + """
         </select>
       </label>
 
@@ -451,8 +3147,7 @@ CHAT_HTML = r"""<!doctype html>
   </div>
 
 <!-- Libraries -->
-<script src="https://cdn.jsdelivr.net/npm/markdown-it@13.0.1/dist/markdown-it.min.js"></script>
-<script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/highlight.min.js"></script>
+""" + "\n".join(f'<script src="{asset_url(n)}"></script>' for n in ("markdown-it.min.js", "highlight.min.js")) + """
 
 <script>
   const md = window.markdownit({
@@ -566,6 +3261,15 @@ CHAT_HTML = r"""<!doctype html>
     lastUser.querySelector('.md').appendChild(transEl);
   }
 
+  function parseSSE(block){
+    let event = 'message', data = '';
+    block.split('\\n').forEach(line => {
+      if(line.startsWith('event:')) event = line.slice(6).trim();
+      else if(line.startsWith('data:')) data += line.slice(5).trim();
+    });
+    try { return {event, data: JSON.parse(data || '{}')}; } catch(_) { return {event, data: {}}; }
+  }
+
   form.addEventListener('submit', async (e)=>{
     e.preventDefault();
     const text = promptEl.value.trim();
@@ -584,17 +3288,42 @@ CHAT_HTML = r"""<!doctype html>
     messagesEl.scrollTop = messagesEl.scrollHeight;
 
     try{
-      const res = await fetch('/api/chat', {method:'POST',headers:{'content-type':'application/json'}, body: JSON.stringify(payload)});
+      const res = await fetch('/api/chat/stream', {method:'POST',headers:{'content-type':'application/json'}, body: JSON.stringify(payload)});
+      if(res.status === 429){ throw new Error('سرور مشغول است؛ ' + (res.headers.get('Retry-After') || 'چند') + ' ثانیه دیگر دوباره تلاش کنید'); }
       if(!res.ok){ throw new Error('server error ' + res.status); }
-      const data = await res.json();
-      document.getElementById('typing')?.remove();
 
-      // show translated under last user
-      if(data.translated && data.translated.length){
-        showTranslatedUnderLastUser(data.translated);
+      // read Server-Sent Events: meta (translation), deltas, then done/error
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      const typingMd = typing.querySelector('.md');
+      let buf = '', reply = '';
+      while(true){
+        const {value, done} = await reader.read();
+        if(done) break;
+        buf += decoder.decode(value, {stream:true});
+        let sep;
+        while((sep = buf.indexOf('\\n\\n')) >= 0){
+          const evt = parseSSE(buf.slice(0, sep));
+          buf = buf.slice(sep + 2);
+          if(evt.event === 'meta'){
+            // show translated under last user
+            if(evt.data.translated && evt.data.translated.length){
+              showTranslatedUnderLastUser(evt.data.translated);
+            }
+          } else if(evt.event === 'error'){
+            throw new Error(evt.data.detail || 'stream error');
+          } else if(evt.event === 'done'){
+            reply = evt.data.reply || reply;
+          } else if(evt.data.delta){
+            reply += evt.data.delta;
+            typingMd.textContent = reply;
+            messagesEl.scrollTop = messagesEl.scrollHeight;
+          }
+        }
       }
+      document.getElementById('typing')?.remove();
 
-      addMessage('assistant', data.reply || '<no-reply>');
+      addMessage('assistant', reply || '<no-reply>');
     }catch(err){
       document.getElementById('typing')?.remove();
       addMessage('assistant', 'خطا: ' + String(err.message || err));
@@ -617,8 +3346,15 @@ CHAT_HTML = r"""<!doctype html>
 </body>
 </html>"""
 
+static_bundle.add("index.html", CHAT_HTML.encode("utf-8"))
+
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['autotune']:
+        # python main.py autotune [device]  -> writes TRANSLATOR_PROFILE
+        logging.basicConfig(level=logging.INFO)
+        print(json.dumps(autotune_translator(*sys.argv[2:3])["best"], indent=2))
+        sys.exit(0)
     import uvicorn
     uvicorn.run('main:app', host='0.0.0.0', port=8000, reload=False)
 
@@ -1,3 +1,8 @@
-from .translator import Translator, OpusmtTranslator, M2m100Translator, NllbTranslator
+from .store import SegmentStore
+
+try:  # the translators need blingfire and ctranslate2; the store alone does not
+    from .translator import Translator, OpusmtTranslator, M2m100Translator, NllbTranslator
+except ImportError:
+    pass
 
 __version__ = "0.0.1"
\ No newline at end of file
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from time import time
+from typing import Dict, Iterable, List, Tuple, Union
+
+
+class SegmentStore:
+    def __init__(self, path: Union[str, Path], timeout: float = 30.0):
+        """Persistent sentence-level translation store backed by SQLite in WAL mode
+
+        The database file can be shared by several processes (e.g. uvicorn workers) and
+        survives restarts. Each thread gets its own connection.
+
+        Args:
+            path (Union[str, Path]): Path to the SQLite database file
+            timeout (float, optional): Seconds to wait on a locked database. Defaults to 30.
+        """
+        self.path = str(path)
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS segments ("
+                "key TEXT PRIMARY KEY, translation TEXT NOT NULL, created REAL NOT NULL)"
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def namespace(model_path: Union[str, Path], **options) -> str:
+        """Build the namespace for a model and a set of decoding options
+
+        Translations are only shared between callers that use the same model and options.
+
+        Args:
+            model_path (Union[str, Path]): Path to the translation model folder
+            **options: Decoding options that affect the output (beam_size, patience, ...)
+
+        Returns:
+            str: Namespace string
+        """
+        opts = json.dumps(
+            {k: v for k, v in options.items() if v is not None},
+            sort_keys=True,
+            default=str,
+        )
+        return f"{Path(model_path).resolve()}|{opts}"
+
+    @staticmethod
+    def key(sentence: str, namespace: str) -> str:
+        """Hash a source sentence within a namespace
+
+        Args:
+            sentence (str): Source sentence
+            namespace (str): Namespace from `SegmentStore.namespace`
+
+        Returns:
+            str: Hex digest used as the primary key
+        """
+        return hashlib.sha256(f"{namespace}\0{sentence}".encode("utf-8")).hexdigest()
+
+    def get_many(self, sentences: Iterable[str], namespace: str) -> Dict[str, str]:
+        """Look up translations for source sentences
+
+        Args:
+            sentences (Iterable[str]): Source sentences
+            namespace (str): Namespace from `SegmentStore.namespace`
+
+        Returns:
+            Dict[str, str]: Mapping of source sentence to stored translation, for hits only
+        """
+        keys = {self.key(s, namespace): s for s in sentences}
+        found = {}
+        items = list(keys.items())
+        conn = self._conn()
+        # stay well below SQLITE_MAX_VARIABLE_NUMBER
+        for start in range(0, len(items), 500):
+            chunk = dict(items[start : start + 500])
+            rows = conn.execute(
+                "SELECT key, translation FROM segments WHERE key IN (%s)"
+                % ",".join("?" * len(chunk)),
+                list(chunk),
+            ).fetchall()
+            for key, translation in rows:
+                found[chunk[key]] = translation
+        return found
+
+    def put_many(self, pairs: List[Tuple[str, str]], namespace: str) -> None:
+        """Store translations
+
+        Args:
+            pairs (List[Tuple[str, str]]): (source sentence, translation) pairs
+            namespace (str): Namespace from `SegmentStore.namespace`
+        """
+        if not pairs:
+            return
+        now = time()
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO segments (key, translation, created) VALUES (?, ?, ?)",
+                [(self.key(src, namespace), tgt, now) for src, tgt in pairs],
+            )
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM segments").fetchone()[0]
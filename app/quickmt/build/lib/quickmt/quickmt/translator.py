@@ -8,16 +8,26 @@ import sentencepiece
 from blingfire import text_to_sentences
 from pydantic import DirectoryPath, validate_call
 
+from .store import SegmentStore
+
 
 class TranslatorABC(ABC):
-    def __init__(self, model_path: DirectoryPath, **kwargs):
+    def __init__(
+        self,
+        model_path: DirectoryPath,
+        segment_store: Optional[SegmentStore] = None,
+        **kwargs,
+    ):
         """Create quickmt translation object
 
         Args:
             model_path (DirectoryPath): Path to quickmt model folder
+            segment_store (SegmentStore, optional): Persistent sentence-level translation store. Sentences found there are not re-translated. Defaults to None.
             **kwargs: CTranslate2 Translator arguments - see https://opennmt.net/CTranslate2/python/ctranslate2.Translator.html
         """
         self.model_path = Path(model_path)
+        self.segment_store = segment_store
+        self.two_pass_stats = {"sentences": 0, "escalated": 0}
         self.translator = ctranslate2.Translator(model_path, **kwargs)
 
     @staticmethod
@@ -114,6 +124,8 @@ class TranslatorABC(ABC):
         verbose: bool = False,
         src_lang: Union[None, str] = None,
         tgt_lang: Union[None, str] = None,
+        two_pass: bool = False,
+        two_pass_threshold: float = -0.5,
         **kwargs,
     ) -> Union[str, List[str]]:
         """Translate a list of strings with quickmt model
@@ -124,6 +136,8 @@ class TranslatorABC(ABC):
             beam_size (int, optional): CTranslate2 Beam size. Defaults to 5.
             patience (int, optional): CTranslate2 Patience. Defaults to 1.
             max_decoding_length (int, optional): Maximum length of translation
+            two_pass (bool, optional): Decode greedily first and re-decode with `beam_size` only the sentences scoring below `two_pass_threshold`. Defaults to False.
+            two_pass_threshold (float, optional): Length-normalized log-probability below which a greedy translation is re-decoded with beam search. Defaults to -0.5.
             **args: Other CTranslate2 translate_batch args, see https://opennmt.net/CTranslate2/python/ctranslate2.Translator.html#ctranslate2.Translator.translate_batch
 
         Returns:
@@ -140,33 +154,84 @@ class TranslatorABC(ABC):
         if verbose:
             print(f"Split sentences: {sentences}")
 
-        input_text = self.tokenize(sentences, src_lang=src_lang, tgt_lang=tgt_lang)
-        if verbose:
-            print(f"Tokenized input: {input_text}")
+        if len(sentences) == 0:
+            return "" if return_string else ["" for _ in src]
 
-        t1 = time()
-        results = self.translate_batch(
-            input_text,
-            beam_size=beam_size,
-            patience=patience,
-            max_decoding_length=max_decoding_length,
-            max_batch_size=max_batch_size,
-            src_lang=src_lang,
-            tgt_lang=tgt_lang,
-            **kwargs,
+        # Sampling is not deterministic, so its output is never stored
+        use_store = self.segment_store is not None and not any(
+            k.startswith("sampling_") for k in kwargs
         )
-        t2 = time()
-        if verbose:
-            print(f"Translation time: {t2-t1}")
+        stored = {}
+        if use_store:
+            namespace = SegmentStore.namespace(
+                self.model_path,
+                beam_size=beam_size,
+                patience=patience,
+                max_decoding_length=max_decoding_length,
+                src_lang=src_lang,
+                tgt_lang=tgt_lang,
+                two_pass_threshold=two_pass_threshold if two_pass else None,
+                **kwargs,
+            )
+            stored = self.segment_store.get_many(
+                [i[2] for i in sentences], namespace
+            )
+            if verbose:
+                print(f"Segment store hits: {len(stored)}/{len(sentences)}")
+
+        # Translate each distinct missing sentence once, in a single batch
+        todo = list(dict.fromkeys(i[2] for i in sentences if i[2] not in stored))
+        if len(todo) > 0:
+            input_text = self.tokenize(
+                [[0, 0, i] for i in todo], src_lang=src_lang, tgt_lang=tgt_lang
+            )
+            if verbose:
+                print(f"Tokenized input: {input_text}")
+
+            t1 = time()
+            if two_pass and beam_size > 1:
+                results = self._translate_two_pass(
+                    input_text,
+                    threshold=two_pass_threshold,
+                    beam_size=beam_size,
+                    patience=patience,
+                    max_decoding_length=max_decoding_length,
+                    max_batch_size=max_batch_size,
+                    src_lang=src_lang,
+                    tgt_lang=tgt_lang,
+                    verbose=verbose,
+                    **kwargs,
+                )
+            else:
+                results = self.translate_batch(
+                    input_text,
+                    beam_size=beam_size,
+                    patience=patience,
+                    max_decoding_length=max_decoding_length,
+                    max_batch_size=max_batch_size,
+                    src_lang=src_lang,
+                    tgt_lang=tgt_lang,
+                    **kwargs,
+                )
+            t2 = time()
+            if verbose:
+                print(f"Translation time: {t2-t1}")
 
-        output_tokens = [i.hypotheses[0] for i in results]
+            output_tokens = [i.hypotheses[0] for i in results]
 
-        if verbose:
-            print(f"Tokenized output: {output_tokens}")
+            if verbose:
+                print(f"Tokenized output: {output_tokens}")
 
-        translated_sents = self.detokenize(
-            output_tokens, src_lang=src_lang, tgt_lang=tgt_lang
-        )
+            new_translations = self.detokenize(
+                output_tokens, src_lang=src_lang, tgt_lang=tgt_lang
+            )
+            if use_store:
+                self.segment_store.put_many(
+                    list(zip(todo, new_translations)), namespace
+                )
+            stored.update(zip(todo, new_translations))
+
+        translated_sents = [stored[i[2]] for i in sentences]
 
         indices = [i[0] for i in sentences]
         paragraphs = [i[1] for i in sentences]
@@ -185,6 +250,48 @@ class TranslatorABC(ABC):
         else:
             return ret
 
+    def _translate_two_pass(
+        self,
+        input_text: List[List[str]],
+        threshold: float,
+        beam_size: int,
+        verbose: bool = False,
+        **kwargs,
+    ):
+        """Greedy pass for every sentence, then one batched beam-search pass for low-scoring ones
+
+        Args:
+            input_text (List[List[str]]): Tokenized sentences
+            threshold (float): Re-decode sentences whose greedy score is below this value. CTranslate2 scores are log-probabilities normalized by length (length_penalty=1 by default).
+            beam_size (int): Beam size of the second pass
+            **kwargs: Other `translate_batch` arguments, used by both passes
+
+        Returns:
+            List: CTranslate2 translation results, in input order
+        """
+        kwargs.pop("return_scores", None)
+        results = list(
+            self.translate_batch(input_text, beam_size=1, return_scores=True, **kwargs)
+        )
+        low = [
+            i
+            for i, r in enumerate(results)
+            if len(r.scores) == 0 or r.scores[0] < threshold
+        ]
+        if len(low) > 0:
+            rescored = self.translate_batch(
+                [input_text[i] for i in low], beam_size=beam_size, **kwargs
+            )
+            for i, r in zip(low, rescored):
+                results[i] = r
+        self.two_pass_stats["sentences"] += len(results)
+        self.two_pass_stats["escalated"] += len(low)
+        if verbose:
+            print(
+                f"Two-pass: {len(low)}/{len(results)} sentences re-decoded with beam search"
+            )
+        return results
+
     @validate_call
     def translate_file(self, input_file: str, output_file: str, **kwargs) -> None:
         """Translate a file with a quickmt model
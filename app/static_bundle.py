@@ -0,0 +1,189 @@
+# static_bundle.py
+"""Static bundle for the chat UI: vendored JS/CSS/fonts, content-hashed and precompressed.
+
+Build (Dockerfile):  python static_bundle.py [--no-fetch]
+    Downloads VENDOR into static/vendor (files already there are kept, so an air-gapped build can copy
+    them in by hand), then writes <dist>/<name>.<hash>.<ext> with .gz/.br siblings and manifest.json.
+    A file that can't be downloaded is skipped with a warning; the page keeps its CDN URL for it.
+    <dist> is $STATIC_DIST_DIR, or static/dist next to this file.
+Run: StaticBundle.load() serves those files, plus pages added in memory, with strong ETags, 304s and
+    the best encoding the client accepts.
+"""
+import gzip, hashlib, json, os, sys, urllib.request
+
+try:  # brotli is optional; without it only gzip is produced
+    import brotli
+except ImportError:
+    brotli = None
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+VENDOR_DIR = os.path.join(BASE_DIR, "vendor")
+# the image builds outside /app, so a development bind mount of ./app doesn't hide the bundle
+DIST_DIR = os.getenv("STATIC_DIST_DIR") or os.path.join(BASE_DIR, "dist")
+URL_PREFIX = "/static/"
+
+FONT_WEIGHTS = (300, 400, 600, 700)
+VENDOR = {
+    "markdown-it.min.js": "https://cdn.jsdelivr.net/npm/markdown-it@13.0.1/dist/markdown-it.min.js",
+    "highlight.min.js": "https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/highlight.min.js",
+    "github.min.css": "https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.8.0/styles/github.min.css",
+    **{f"jetbrains-mono-latin-{w}-normal.woff2":
+       f"https://cdn.jsdelivr.net/npm/@fontsource/jetbrains-mono@5/files/jetbrains-mono-latin-{w}-normal.woff2"
+       for w in FONT_WEIGHTS},
+}
+
+CONTENT_TYPES = {
+    ".js": "text/javascript; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".html": "text/html; charset=utf-8",
+    ".json": "application/json",
+    ".svg": "image/svg+xml",
+    ".woff2": "font/woff2",
+    ".png": "image/png",
+}
+COMPRESSIBLE = (".js", ".css", ".html", ".json", ".svg")
+ENCODING_SUFFIX = {"gzip": "gz", "br": "br"}
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def content_type(name):
+    return CONTENT_TYPES.get(os.path.splitext(name)[1], "application/octet-stream")
+
+
+def compress(body, name):
+    """Encoded variants worth serving: {"br": ..., "gzip": ...}, each only if smaller than `body`."""
+    if not name.endswith(COMPRESSIBLE):
+        return {}
+    variants = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=11)
+    return {enc: data for enc, data in variants.items() if len(data) < len(body)}
+
+
+def fetch_vendor(dest=VENDOR_DIR):
+    """Download missing VENDOR files into `dest`; returns the names that couldn't be fetched."""
+    os.makedirs(dest, exist_ok=True)
+    missing = []
+    for name, url in VENDOR.items():
+        path = os.path.join(dest, name)
+        if os.path.exists(path):
+            continue
+        print(f"fetch {url}")
+        try:
+            with urllib.request.urlopen(url, timeout=60) as r:
+                body = r.read()
+        except OSError as e:  # URLError, timeouts, DNS failures
+            print(f"warning: {name} not fetched ({e}); the page will load it from the CDN", file=sys.stderr)
+            missing.append(name)
+            continue
+        with open(path + ".tmp", "wb") as f:
+            f.write(body)
+        os.replace(path + ".tmp", path)
+    return missing
+
+
+def build(src=VENDOR_DIR, out=DIST_DIR):
+    """Hash and precompress every file in `src` into `out`; returns the manifest."""
+    os.makedirs(out, exist_ok=True)
+    manifest = {}
+    names = sorted(os.listdir(src)) if os.path.isdir(src) else []
+    for name in names:
+        if name.startswith(".") or name.endswith(".tmp"):
+            continue
+        with open(os.path.join(src, name), "rb") as f:
+            body = f.read()
+        digest = hashlib.sha256(body).hexdigest()
+        root, ext = os.path.splitext(name)
+        hashed = f"{root}.{digest[:12]}{ext}"
+        variants = compress(body, name)
+        for suffix, data in [("", body)] + [("." + ENCODING_SUFFIX[enc], data) for enc, data in variants.items()]:
+            with open(os.path.join(out, hashed + suffix), "wb") as f:
+                f.write(data)
+        manifest[name] = {"file": hashed, "etag": digest[:32], "type": content_type(name),
+                          "encodings": sorted(variants)}
+        print(f"{name} -> {hashed} ({len(body)} B" + "".join(f", {e} {len(d)} B" for e, d in variants.items()) + ")")
+    with open(os.path.join(out, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def accepted_encodings(header):
+    accepted = set()
+    for part in (header or "").split(","):
+        token, _, params = part.partition(";")
+        if params.replace(" ", "").lower() in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(token.strip().lower())
+    return accepted
+
+
+class Asset:
+    __slots__ = ("body", "etag", "type", "cache", "encodings")
+
+    def __init__(self, body, etag, type, cache, encodings):
+        self.body, self.etag, self.type, self.cache, self.encodings = body, etag, type, cache, encodings
+
+
+class StaticBundle:
+    """Assets held in memory, keyed by the name they are served under.
+
+    Hashed files from the build are cached for a year as immutable; pages added with add() keep a
+    stable name and get `no-cache`, so a browser revalidates them with one conditional request (304).
+    """
+
+    def __init__(self):
+        self.assets: dict[str, Asset] = {}
+        self.urls: dict[str, str] = {}  # logical name -> URL of the hashed file
+
+    @classmethod
+    def load(cls, dist=DIST_DIR):
+        bundle = cls()
+        try:
+            with open(os.path.join(dist, "manifest.json")) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return bundle  # not built: pages fall back to the CDN URLs
+        for name, entry in manifest.items():
+            def read(suffix=""):
+                with open(os.path.join(dist, entry["file"] + suffix), "rb") as f:
+                    return f.read()
+            encodings = {enc: read("." + ENCODING_SUFFIX[enc]) for enc in entry["encodings"]}
+            bundle.assets[entry["file"]] = Asset(read(), entry["etag"], entry["type"], IMMUTABLE, encodings)
+            bundle.urls[name] = URL_PREFIX + entry["file"]
+        return bundle
+
+    def add(self, name, body, type=None):
+        """Serve `body` (bytes) under `name`, compressed once now."""
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        self.assets[name] = Asset(body, etag, type or content_type(name), "no-cache", compress(body, name))
+
+    def url(self, name):
+        return self.urls.get(name)
+
+    def lookup(self, name, if_none_match=None, accept_encoding=None):
+        """(status, body, headers) for a GET of `name`, or None if unknown."""
+        asset = self.assets.get(name)
+        if asset is None:
+            return None
+        accepted = accepted_encodings(accept_encoding)
+        encoding = next((e for e in ("br", "gzip") if e in asset.encodings and e in accepted), None)
+        etag = f'"{asset.etag}-{encoding}"' if encoding else f'"{asset.etag}"'
+        headers = {"ETag": etag, "Cache-Control": asset.cache}
+        if asset.encodings:
+            headers["Vary"] = "Accept-Encoding"
+        if if_none_match:
+            # any representation of the same content is still fresh
+            tags = {t.strip().removeprefix("W/").strip('"').split("-")[0] for t in if_none_match.split(",")}
+            if asset.etag in tags or "*" in tags:
+                return 304, b"", headers
+        headers["Content-Type"] = asset.type
+        if encoding:
+            headers["Content-Encoding"] = encoding
+            return 200, asset.encodings[encoding], headers
+        return 200, asset.body, headers
+
+
+if __name__ == "__main__":
+    if "--no-fetch" not in sys.argv[1:]:
+        fetch_vendor()
+    build()
@@ -0,0 +1,95 @@
+# Tests import the app the way uvicorn does (`main` from app/), with quickmt on the path as in the Dockerfile.
+# main downloads the translation model on import when ./quickmt-fa-en is missing; no test decodes, so they
+# run from a scratch directory holding an empty model folder (which also keeps the SQLite files out of app/).
+import asyncio, json, os, sys, tempfile
+
+import httpx
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [APP_DIR, os.path.join(APP_DIR, "quickmt", "build", "lib", "quickmt")]
+
+_workdir = tempfile.mkdtemp(prefix="razor-tests-")
+os.makedirs(os.path.join(_workdir, "quickmt-fa-en"))
+os.chdir(_workdir)
+
+import main  # noqa: E402
+
+
+class StubHost:
+    """One fake Ollama host: answers /api/chat with `reply`, streamed one word per line when asked.
+
+    `down` refuses connections; `status` fails every call with that HTTP status; `delay` holds back the
+    response headers; while `gate` is set to an unset asyncio.Event, a streamed reply stops after its
+    first word until the event is set.
+    """
+
+    def __init__(self, base, reply="hello from the stub"):
+        self.base = base
+        self.reply = reply
+        self.down = False
+        self.status = 200
+        self.delay = 0.0
+        self.gate: asyncio.Event | None = None
+        self.calls: list[dict] = []
+
+    async def chat(self, request):
+        if self.down:
+            raise httpx.ConnectError("connection refused", request=request)
+        payload = json.loads(request.content)
+        self.calls.append(payload)
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.status != 200:
+            return httpx.Response(self.status, json={"error": "stub failure"})
+        if not payload.get("stream"):
+            return httpx.Response(200, json={"message": {"role": "assistant", "content": self.reply}, "done": True})
+        return httpx.Response(200, content=self._lines())
+
+    async def _lines(self):
+        for i, word in enumerate(self.reply.split()):
+            if i == 1 and self.gate is not None:
+                await self.gate.wait()
+            yield (json.dumps({"message": {"role": "assistant", "content": word + " "}, "done": False}) + "\n").encode()
+        yield (json.dumps({"done": True, "eval_count": 3}) + "\n").encode()
+
+
+class StubOllama:
+    """Several StubHosts behind one httpx.MockTransport, wired into main's client, pool, caches and sessions."""
+
+    def __init__(self, monkeypatch, count):
+        self.hosts = [StubHost(f"http://ollama-{i}:11434") for i in range(count)]
+        by_base = {h.base: h for h in self.hosts}
+
+        async def handler(request):
+            host = by_base[f"{request.url.scheme}://{request.url.host}:{request.url.port}"]
+            if request.url.path == main.OLLAMA_CHAT_PATH:
+                return await host.chat(request)
+            return httpx.Response(404, json={"error": "not stubbed"})
+
+        monkeypatch.setattr(main, "create_ollama_client",
+                            lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        monkeypatch.setattr(main, "ollama_client", None)
+        monkeypatch.setattr(main, "ollama_pool", main.OllamaPool(list(by_base)))
+        monkeypatch.setattr(main, "first_byte", main.FirstByteWindow())
+        monkeypatch.setattr(main, "provisioner", main.ModelProvisioner(models=[]))
+        monkeypatch.setattr(main, "RESPONSE_CACHE_SIZE", 64)  # off by default
+        monkeypatch.setattr(main, "response_cache", main.TranslationCache(max_entries=64))
+        monkeypatch.setattr(main, "response_streams", {})
+        monkeypatch.setattr(main, "CONVERSATIONS", main.MemoryConversationStore())
+        monkeypatch.setattr(main, "OLLAMA_RETRY_BASE_DELAY", 0.0)
+        self.pool = main.ollama_pool
+
+    def run(self, coro):
+        """Run `coro` on a fresh event loop, closing the Ollama client it opened."""
+        async def go():
+            try:
+                return await coro
+            finally:
+                await main.close_ollama_client()
+        return asyncio.run(go())
+
+
+@pytest.fixture
+def ollama(monkeypatch):
+    return StubOllama(monkeypatch, 3)
@@ -0,0 +1,97 @@
+import asyncio, json
+
+import httpx
+
+import main
+
+
+def sse(text):
+    """[(event, data)] of an SSE body."""
+    events = []
+    for block in text.strip().split("\n\n"):
+        lines = block.split("\n")
+        event = lines[0][len("event: "):] if lines[0].startswith("event: ") else "message"
+        events.append((event, json.loads(lines[-1][len("data: "):])))
+    return events
+
+
+def reply_of(response):
+    return "".join(d["delta"] for e, d in sse(response.text) if e == "message")
+
+
+async def post_stream(client, session_id):
+    return await client.post("/api/chat/stream", json={"message": "hi there", "session_id": session_id})
+
+
+def test_identical_streams_share_one_generation(ollama):
+    async def go():
+        gate = asyncio.Event()
+        for h in ollama.hosts:
+            h.gate = gate
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://t") as c:
+            first = asyncio.create_task(post_stream(c, "s1"))
+            # the second request arrives once the first one is already relaying deltas
+            while not any(s.parts for s in main.response_streams.values()):
+                await asyncio.sleep(0.01)
+            second = asyncio.create_task(post_stream(c, "s2"))
+            while not main.response_cache.coalesced:
+                await asyncio.sleep(0.01)
+            gate.set()
+            return await first, await second
+
+    first, second = ollama.run(go())
+    assert sum(len(h.calls) for h in ollama.hosts) == 1
+    assert (first.headers["x-cache"], second.headers["x-cache"]) == ("MISS", "COALESCED")
+    assert reply_of(first) == reply_of(second) == "hello from the stub "
+    assert sse(second.text)[-1] == ("done", {"reply": "hello from the stub "})
+    assert not main.response_streams and all(h.outstanding == 0 for h in ollama.pool.hosts)
+
+
+def test_finished_stream_is_served_from_the_cache(ollama):
+    async def go():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://t") as c:
+            return await post_stream(c, "s1"), await post_stream(c, "s2")
+
+    first, second = ollama.run(go())
+    assert sum(len(h.calls) for h in ollama.hosts) == 1
+    assert second.headers["x-cache"] == "HIT" and reply_of(second) == reply_of(first)
+
+
+def test_upstream_runs_while_any_client_is_left(ollama):
+    host = ollama.hosts[0]
+    payload = main.ollama_request(main.OLLAMA_MODEL, [{'role': 'user', 'content': 'hi'}], stream=True)
+
+    async def go():
+        host.gate = asyncio.Event()
+        stream = main.ChatStream(payload, "key")
+        stream.open(None)
+        await stream.join().opened()
+        stream.leave()  # the first client goes away; the second is still reading
+        host.gate.set()
+        reply = "".join([d async for d in stream.follow()])
+        stream.leave()
+        return stream, reply
+
+    stream, reply = ollama.run(go())
+    assert stream.error is None and reply == "hello from the stub "
+    assert all(h.outstanding == 0 for h in ollama.pool.hosts)
+
+
+def test_upstream_is_closed_when_every_client_left(ollama):
+    payload = main.ollama_request(main.OLLAMA_MODEL, [{'role': 'user', 'content': 'hi'}], stream=True)
+
+    async def go():
+        for h in ollama.hosts:
+            h.gate = asyncio.Event()  # never set
+        stream = main.ChatStream(payload, "key")
+        stream.open(None)
+        await stream.opened()
+        while not stream.parts:
+            await asyncio.sleep(0.01)
+        stream.leave()
+        await asyncio.sleep(0.05)
+        return stream
+
+    stream = ollama.run(go())
+    assert stream.done and "key" not in main.response_streams and main.response_cache.get("key") is None
+    assert all(h.outstanding == 0 for h in ollama.pool.hosts)
@@ -0,0 +1,143 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+MODEL = main.model_key(main.OLLAMA_MODEL)
+
+
+def chat(stream=False):
+    return main.ollama_request(MODEL, [{'role': 'user', 'content': 'hi'}], stream=stream)
+
+
+async def call(payload, session_id=None):
+    """open_ollama + release, like ollama_chat; returns the host that answered."""
+    lease, r = await main.open_ollama(payload, session_id)
+    await r.aread()
+    await r.aclose()
+    main.ollama_pool.release(lease)
+    return lease.host
+
+
+def test_least_outstanding_host_wins(ollama):
+    pool = ollama.pool
+    leases = [pool.acquire(MODEL) for _ in range(3)]
+    assert {l.host for l in leases} == set(pool.hosts)
+    pool.release(leases[1])
+    assert pool.acquire(MODEL).host is leases[1].host
+
+
+def test_host_with_the_model_loaded_is_preferred(ollama):
+    pool = ollama.pool
+    warm = pool.hosts[2]
+    warm.loaded.add(MODEL)
+    warm.outstanding = 5
+    assert pool.acquire(MODEL).host is warm
+    pool.hosts[1].available.add(MODEL)
+    warm.breaker, warm.open_until = "open", float("inf")  # not loaded anywhere live: on disk beats nothing
+    assert pool.acquire(MODEL).host is pool.hosts[1]
+
+
+def test_session_sticks_to_its_host_within_the_slack(ollama):
+    pool = ollama.pool
+    home = pool.acquire(MODEL, "s1").host
+    home.outstanding += pool.affinity_slack - 1  # busier than the others, but within the slack
+    assert pool.acquire(MODEL, "s1").host is home
+    assert pool.acquire(MODEL, "s2").host is not home
+    home.outstanding += pool.affinity_slack
+    moved = pool.acquire(MODEL, "s1").host
+    assert moved is not home
+    assert pool.acquire(MODEL, "s1").host is moved  # affinity follows the move
+
+
+def test_failing_host_is_ejected_then_recovers_through_one_trial(ollama):
+    pool = ollama.pool
+    sick = pool.hosts[0]
+    error = httpx.HTTPStatusError("boom", request=None, response=httpx.Response(500))
+    for _ in range(pool.eject_after):
+        pool.release(pool.acquire(MODEL, avoid=set(pool.hosts[1:])), error)
+    assert sick.breaker_state() == "open" and sick.ejected
+    assert all(pool.acquire(MODEL).host is not sick for _ in range(6))
+
+    sick.open_until = 0.0  # eject_sec has passed
+    trial = pool.acquire(MODEL, avoid=set(pool.hosts[1:]))
+    assert trial.trial and trial.host is sick and sick.ejected  # nothing else goes there meanwhile
+    pool.release(trial)
+    assert sick.breaker_state() == "closed" and not sick.ejected
+
+
+def test_failed_trial_opens_the_breaker_again(ollama):
+    pool = ollama.pool
+    sick = pool.hosts[0]
+    sick.set_breaker("half_open")
+    trial = pool.acquire(MODEL, avoid=set(pool.hosts[1:]))
+    pool.release(trial, httpx.ConnectError("refused"))
+    assert sick.breaker_state() == "open"
+
+
+def test_only_the_trial_lease_settles_a_half_open_host(ollama):
+    pool = ollama.pool
+    host = pool.hosts[0]
+    old = pool.acquire(MODEL, avoid=set(pool.hosts[1:]))  # started before the breaker opened
+    pool._trip(host, "health check failed")
+    host.open_until = 0.0
+    trial = pool.acquire(MODEL, avoid=set(pool.hosts[1:]))
+    assert trial.host is host and trial.trial and not old.trial
+    pool.release(old, httpx.ConnectError("refused"))  # one failure, below eject_after
+    assert host.trial and host.breaker_state() == "half_open" and host.ejected
+    pool.release(trial)
+    assert not host.trial and host.breaker_state() == "closed"
+
+
+def test_every_breaker_open_fails_fast(ollama):
+    for h in ollama.pool.hosts:
+        ollama.pool._trip(h, "down")
+    with pytest.raises(main.OllamaUnavailable):
+        ollama.pool.acquire(MODEL)
+    assert main.ollama_error(main.OllamaUnavailable(3.0)).status_code == 503
+
+
+def test_connection_retry_goes_to_another_host(ollama):
+    down = ollama.hosts[0]
+    down.down = True
+    ollama.pool._affinity["s1"] = ollama.pool.hosts[0]  # the session's previous host
+
+    host = ollama.run(call(chat(), "s1"))
+    assert host.base != down.base and not down.calls
+    assert ollama.pool.hosts[0].failures == 1
+    assert all(h.outstanding == 0 for h in ollama.pool.hosts)
+
+
+def test_server_errors_are_not_retried(ollama):
+    for h in ollama.hosts:
+        h.status = 500
+    with pytest.raises(httpx.HTTPStatusError):
+        ollama.run(call(chat()))
+    assert sum(len(h.calls) for h in ollama.hosts) == 1
+
+
+def test_slow_host_is_hedged_to_another(ollama, monkeypatch):
+    monkeypatch.setattr(main, "OLLAMA_HEDGE", True)
+    monkeypatch.setattr(main, "first_byte", main.FirstByteWindow(min_samples=1))
+    main.first_byte.observe(MODEL, False, 0.01)
+    slow = ollama.hosts[0]
+    slow.delay = 1.0
+
+    async def go():
+        host = await call(chat())
+        await asyncio.sleep(0)  # let the losing attempt be cancelled and released
+        return host
+
+    host = ollama.run(go())
+    assert host.base != slow.base and len(slow.calls) == 1
+    assert all(h.outstanding == 0 for h in ollama.pool.hosts)
+
+
+def test_hedge_deadlines_are_kept_per_mode(ollama):
+    window = main.FirstByteWindow(min_samples=1)
+    window.observe(MODEL, False, 30.0)  # a full reply: headers only after the whole answer
+    assert window.deadline(MODEL, True) is None
+    window.observe(MODEL, True, 0.2)
+    assert (window.deadline(MODEL, False), window.deadline(MODEL, True)) == (30.0, 0.2)
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def decodes(monkeypatch):
+    """Fresh cache and policy; every decode that actually runs is recorded as (beam_size, patience)."""
+    calls = []
+
+    async def fake_uncached(text, decoding):
+        calls.append((decoding['beam_size'], decoding['patience']))
+        return f"en({text})"
+
+    monkeypatch.setattr(main, "translation_cache", main.TranslationCache())
+    monkeypatch.setattr(main, "decoding_policy", main.DecodingPolicy())
+    monkeypatch.setattr(main, "_translate_uncached", fake_uncached)
+    return calls
+
+
+TEXT = "این یک جمله نسبتا طولانی برای آزمایش است"
+
+
+def test_reduced_beam_reuses_idle_full_beam_translation(decodes):
+    async def go():
+        idle = await main.translate_text(TEXT)
+        reduced = main.decoding_policy.choose(TEXT) | {'beam_size': max(1, main.BEAM // 2), 'patience': 1}
+        return idle, await main.translate_text(TEXT, reduced)
+
+    idle, reduced = asyncio.run(go())
+    assert decodes == [(main.BEAM, main.DECODE_PATIENCE)]
+    assert reduced == idle
+
+
+def test_full_beam_under_load_reuses_idle_translation(decodes):
+    async def go():
+        await main.translate_text(TEXT)
+        main.decoding_policy.pending = 1  # one request ahead of us: full beam, patience 1
+        busy = main.decoding_policy.choose(TEXT)
+        assert (busy['beam_size'], busy['patience']) == (main.BEAM, 1)
+        await main.translate_text(TEXT, busy)
+
+    asyncio.run(go())
+    assert decodes == [(main.BEAM, main.DECODE_PATIENCE)]
+
+
+def test_reduced_beam_results_stay_separate(decodes):
+    async def go():
+        reduced = main.decoding_policy.choose(TEXT) | {'beam_size': max(1, main.BEAM // 2), 'patience': 1}
+        await main.translate_text(TEXT, reduced)
+        await main.translate_text(TEXT)  # a reduced-beam result must not stand in for a full-beam one
+
+    asyncio.run(go())
+    assert decodes == [(max(1, main.BEAM // 2), 1), (main.BEAM, main.DECODE_PATIENCE)]